@@ -1 +1,3 @@
 from .asynctcp import *
+from .pool import BlockingTcpClientPool
+from .replicas import HedgedTcpClient
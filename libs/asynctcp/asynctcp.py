@@ -1,81 +1,249 @@
 import base64
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from contextlib import suppress
+from hashlib import blake2b
 from importlib import import_module
+from itertools import count
 import json
 import logging
-from multiprocessing import cpu_count, current_process
-from os import remove, environ as env
+from multiprocessing import cpu_count, current_process, get_context, Pipe
+from os import _exit, fork, kill, remove, environ as env
 from os.path import exists
+import pickle
 from secrets import token_bytes
-from signal import SIGTERM, SIGINT
+from signal import signal, SIG_DFL, SIG_IGN, SIGCHLD, SIGTERM, SIGINT
 import socket
 import sys
+from threading import Lock as ThreadLock, Thread
+from time import monotonic
 from warnings import catch_warnings, filterwarnings
 
 from curio import (
     aside,
     CancelledError,
     Channel,
+    Event,
+    Lock,
+    open_unix_connection,
     Queue,
     run,
+    Semaphore,
     SignalSet,
+    sleep,
     socket as curiosocket,
     spawn,
-    TaskError,
     TaskTimeout,
     timeout_after,
     wait,
 )
+from curio.channel import Connection
 
 from rsyslog import setup
 
+from . import codec
+from .cache import PendingResponse, ResponseCache, SharedResponseCache, TieredCache
+from .metrics import Metrics
+from .protocol import (
+    CONTROL_KEY,
+    frame,
+    hello_frame,
+    FrameReader,
+    FrameTooLarge,
+    HEADER,
+    JsonReader,
+    MAGIC,
+    MULTIPLEXED_HEADER,
+    PROTOCOL_VERSION,
+)
+from .scheduler import FairQueue
+from .sharedmemory import Attachments, SegmentPool, SharedMemory, SharedPayload
+
 
 LOGGER = logging.getLogger(__name__)
 
+NEGOTIATION_TIMEOUT = 3
+
+CONTROL_MARKER = CONTROL_KEY.encode('utf-8')
+
+SERVICE_TIME_SMOOTHING = .1 # weight of the latest handler latency in the moving average used to estimate queue waits
+
+
+class Overloaded(Exception):
+    '''
+    Raised when a request is rejected or dropped rather than handled, because the server can't handle it in time.
+    '''
+    pass
+
+
+def load_handler(request_handler, search_path):
+    if search_path is not None:
+        sys.path.insert(0, search_path)
+    if isinstance(request_handler, str):
+        module, handler_name = request_handler.rsplit('.', 1)
+        return getattr(import_module(module), handler_name)
+    return request_handler
+
 
 async def worker_main(
     id,
     channel,
     authkey,
     request_handler,
-    search_path
+    search_path,
+    preloaded = False,
+    concurrency = 1,
+    shared_memory_threshold = None,
 ):
     '''
     This task runs inside a subprocess spawned by the AsyncTcpCallbackServer.
     It creates a connection to the 'channel', receives requests via the connection,
     runs the 'request_handler' on the request, 
     sends the response back to the AsyncTcpCallbackServer via the connection.
+    Requests and responses are tagged, so up to 'concurrency' requests can be handled at once,
+    which lets handlers awaiting I/O overlap. The default of 1 handles one request at a time.
+    If 'preloaded' is True, the subprocess was forked from a worker template
+    which already imported the 'request_handler' and set up logging.
+    If 'shared_memory_threshold' is set, requests and responses of at least that many bytes
+    go through shared memory segments instead of the connection, see asynctcp.sharedmemory.
     '''
-    if search_path is not None:
-        sys.path.insert(0, search_path)
-
+    handler = load_handler(request_handler, search_path)
     if isinstance(request_handler, str):
-        module, handler_name = request_handler.rsplit('.', 1)
-        handler = getattr(import_module(module), handler_name)
         current_process().name = f'{request_handler}.{id}.{current_process().pid}'
     else:
-        handler = request_handler
         current_process().name = f'{request_handler.__module__}.{request_handler.__name__}.{id}.{current_process().pid}'
 
-    setup(log_level=env['LOG_LEVEL'] if 'LOG_LEVEL' in env else 'DEBUG')
+    if not preloaded:
+        setup(log_level=env['LOG_LEVEL'] if 'LOG_LEVEL' in env else 'DEBUG')
 
     async with await channel.connect(authkey=authkey) as connection:
-        while True:
+        send_lock = Lock()
+        slots = Semaphore(concurrency)
+        segments = SegmentPool() if shared_memory_threshold else None
+        attachments = Attachments() if shared_memory_threshold else None
+
+        async def handle(tag, request):
+            start = monotonic()
             try:
-                handler_task = None
-                request = await connection.recv()
-                try:
-                    handler_task  = await spawn(handler(request))
-                    response = await handler_task.join()
-                except TaskError as exc:
-                    LOGGER.exception('TaskError detected in worker_main')
-                    response = json.dumps(None)
-                finally:
-                    await connection.send(response)
-            except CancelledError:
-                if handler_task:
-                    await handler_task.cancel()
-                break
+                response = await handler(request)
+            except Exception:
+                LOGGER.exception('Exception raised by the request handler in worker_main')
+                response = json.dumps(None)
+            if segments is not None:
+                response = response.encode('utf-8')
+                if len(response) >= shared_memory_threshold:
+                    response = segments.put(response)
+            async with send_lock:
+                # the handler's latency lets the server tell it apart from the time spent queued and in transit
+                await connection.send((tag, response, monotonic() - start))
+            await slots.release()
+
+        handler_tasks = []
+        try:
+            while True:
+                await slots.acquire()
+                message = await connection.recv()
+                if isinstance(message, SharedPayload):
+                    message = attachments.load(message)
+                tag, request = message
+                if tag is None:
+                    # the server read the response held in the segment named 'request'
+                    segments.release(request)
+                    await slots.release()
+                    continue
+                handler_tasks = [ task for task in handler_tasks if not task.terminated ]
+                handler_tasks.append( await spawn(handle(tag, request), daemon=True) )
+        except CancelledError:
+            for task in handler_tasks:
+                await task.cancel()
+        finally:
+            if segments is not None:
+                segments.close()
+                attachments.close()
+
+
+async def forked_worker_main(*args, **kwargs):
+    '''
+    Runs 'worker_main' in a subprocess forked by the worker template, until it gets SIGTERM from ForkedWorker.cancel.
+    Cancelling 'worker_main' rather than being killed lets it destroy its shared memory segments.
+    '''
+    async def cancel_on_sigterm(task):
+        await SignalSet(SIGTERM).wait()
+        await task.cancel()
+    worker_task = await spawn(worker_main(*args, **kwargs))
+    await spawn(cancel_on_sigterm(worker_task), daemon=True)
+    await worker_task.wait()
+
+
+def worker_template_main(control, channel, authkey, request_handler, search_path, concurrency, shared_memory_threshold):
+    '''
+    This function runs inside the template process of an AsyncTcpCallbackServer started with 'preload'.
+    It imports the 'request_handler' and sets up logging once,
+    then forks a ready-to-serve worker subprocess for every worker id received via the 'control' connection,
+    and sends back the pid of that subprocess.
+    '''
+    handler = load_handler(request_handler, search_path)
+    current_process().name = f'{handler.__module__}.{handler.__name__}.template.{current_process().pid}'
+    setup(log_level=env['LOG_LEVEL'] if 'LOG_LEVEL' in env else 'DEBUG')
+    signal(SIGINT, SIG_IGN) # the server shuts the workers down itself
+    signal(SIGCHLD, SIG_IGN) # forked workers are reaped automatically
+    while True:
+        try:
+            id = control.recv()
+        except EOFError:
+            break
+        pid = fork()
+        if pid == 0:
+            control.close()
+            signal(SIGCHLD, SIG_DFL)
+            run(forked_worker_main(
+                id,
+                channel,
+                authkey,
+                handler,
+                None,
+                preloaded=True,
+                concurrency=concurrency,
+                shared_memory_threshold=shared_memory_threshold,
+            ))
+            _exit(0)
+        control.send(pid)
+
+
+class ForkedWorker(object):
+    '''
+    Stands for the task of a worker subprocess forked by the worker template, so it can be cancelled the same way.
+    '''
+    def __init__(self, pid):
+        self.pid = pid
+
+    async def cancel(self):
+        with suppress(ProcessLookupError):
+            kill(self.pid, SIGTERM)
+
+
+class WorkerTemplate(object):
+    '''
+    Starts and controls the template process that forks the worker subprocesses of a server started with 'preload'.
+    '''
+    def __init__(self, channel, authkey, request_handler, search_path, concurrency, shared_memory_threshold):
+        control, template_control = Pipe()
+        self.process = get_context('spawn').Process(
+            target=worker_template_main,
+            args=(template_control, channel, authkey, request_handler, search_path, concurrency, shared_memory_threshold),
+            daemon=True,
+        )
+        self.process.start()
+        template_control.close()
+        self.control = Connection.from_Connection(control)
+
+    async def fork(self, id):
+        await self.control.send(id)
+        return ForkedWorker(await self.control.recv())
+
+    async def close(self):
+        await self.control.close()
+        self.process.terminate()
 
 
 class AsyncTcpCallbackServer(object):
@@ -84,6 +252,11 @@ class AsyncTcpCallbackServer(object):
     2) sends json object to callback as native python object (dict)
         - callback should return a string type
     3) encodes string as utf-8 encoded bytestring and sends to client
+
+    Clients may instead negotiate the framed protocol (see asynctcp.protocol) when they connect.
+    Framed messages carry their length, so each one is decoded exactly once, whatever its size.
+    On a multiplexed connection, every request is dispatched as soon as it is received,
+    so one client can keep all the workers busy. Replies are sent back as soon as they are ready.
     '''
     def __init__(
         self,
@@ -91,11 +264,29 @@ class AsyncTcpCallbackServer(object):
         port,
         request_handler,
         memoized = True,
+        cache = None,
+        raw_cache_keys = False,
         buffer_size = 1 << 13,
         parallel = True,
         cpus = None,
         search_path = None,
         worker_subprocess_timeout = 600,
+        min_workers = 0,
+        max_workers = None,
+        scale_up_wait = 0,
+        warm_up = False,
+        preload = False,
+        worker_concurrency = 1,
+        stats_port = None,
+        max_queued_requests = None,
+        backlog = 100,
+        max_connections = None,
+        tenant_weights = None,
+        shared_memory_threshold = None,
+        acceptors = 1,
+        binary = False,
+        compression_threshold = None,
+        max_frame_size = 1 << 28,
     ):
         '''
             address:        the address the listening socket will bind to.
@@ -105,150 +296,768 @@ class AsyncTcpCallbackServer(object):
                             You may need to provide an additional search path in 'search_path' if the handler can't be found. 
                             This usually happens if your handler is defined in a script but not in a library.
             memoized:       True is responses are to be cached. Defaults to True.
+            cache:          the cache holding the responses if 'memoized' is True.
+                            Defaults to a ResponseCache with its default entry count and size limits.
+                            A SharedResponseCache shares the responses with the other servers of the host using the same path,
+                            and keeps them across restarts. A TieredCache keeps the most used ones in memory in front of it.
+            raw_cache_keys: if True, responses are cached under a hash of the received message rather than of the decoded request.
+                            On framed connections, cached responses are then sent back without decoding the request at all.
+                            Defaults to False.
             buffer_size:    the maximum amount of data to be received at once from the client connection. Defaults to 8KB.
             parallel:       if True, handle all received requests in parallel, using a pool of processes. Defaults to True.
             cpus:           number of processes if 'parallel' is True. Defaults to None which means match the number of CPUs on the host machine.
             search_path:    path of the module containing the 'request_handler' definition. Will be prepended to sys.path when workers boot.
             worker_subprocess_timeout: timeout in seconds after which the subprocesses will be killed if no new request is queued up.
                             Defaults to 5 seconds.
+            min_workers:    number of worker subprocesses kept running even when idle. Defaults to 0.
+            max_workers:    maximum number of worker subprocesses. Defaults to 'cpus'.
+            scale_up_wait:  time in seconds a request may wait in the queue before an additional worker subprocess is started.
+                            Defaults to 0, which starts one as soon as a request is queued and no worker is available.
+            warm_up:        if True, start the 'min_workers' subprocesses along with the server instead of on the first requests.
+                            Defaults to False.
+            preload:        if True, import the 'request_handler' and set up logging once, in a template process,
+                            and fork the worker subprocesses from it. This makes starting a worker much faster
+                            for handlers with expensive imports. Defaults to False.
+            worker_concurrency: maximum number of requests handled at once by each worker subprocess.
+                            Values above 1 let I/O-bound handlers overlap while they await. Defaults to 1.
+            stats_port:     if set, every connection to this port on 127.0.0.1 is sent the server stats as JSON, then closed.
+                            With several acceptors, the stats are {'acceptors': [the stats of each acceptor]}.
+                            The stats are also returned for the control message {"__asynctcp__": "stats"}
+                            sent on the main port, see BlockingTcpClient.stats. Defaults to None.
+            max_queued_requests: if set and 'parallel' is True, requests received while that many are waiting for a worker
+                            are answered right away with an 'Overloaded' error. Defaults to None, meaning no limit.
+            backlog:        size of the listening socket's backlog of connections not accepted yet. Defaults to 100.
+            max_connections: if set, connections beyond that many are left in the backlog until another one closes.
+                            Defaults to None, meaning no limit.
+            tenant_weights: dict of tenant -> number of requests of that tenant a worker takes in a row, see below.
+                            Defaults to 1 for every tenant.
+            shared_memory_threshold: if set and 'parallel' is True, requests and responses of at least that many bytes
+                            are passed to and from the worker subprocesses in shared memory segments,
+                            rather than written to and read from their connection. Requires Python 3.8.
+                            Defaults to None.
+            acceptors:      number of front-end processes accepting connections on the port, bound with SO_REUSEPORT.
+                            Each one decodes, caches and answers the requests of its own connections,
+                            and has its own pool of up to 'max_workers' worker subprocesses. Defaults to 1.
+            binary:         if True, framed connections may send requests in the binary encoding of asynctcp.codec,
+                            whose bytes values reach the request handler as bytes rather than base64 encoded text.
+                            Only enable it if the handler accepts both. Defaults to False.
+            compression_threshold: if set, framed connections may compress their payloads,
+                            and replies of at least that many bytes are compressed. Defaults to None.
+            max_frame_size: maximum size in bytes of the payload of a frame, since the buffer of a frame is allocated
+                            from the size announced by the client. A larger frame is replied to with an InvalidRequest error,
+                            and its connection is closed. Defaults to 256MB.
+
+        Requests waiting for a worker are queued per connection, and the connections take turns, see FairQueue.
+        A request may be sent in an envelope with the following options:
+            {"__asynctcp__": {"timeout": 5, "tenant": "acme", "priority": 1}, "request": <request>}
+            timeout:        how long the client will wait for the reply, in seconds.
+                            The request is answered with an 'Overloaded' error instead of being queued if the estimated wait
+                            for a worker already exceeds it, and it is dropped if it expires while queued.
+            tenant:         the requests of a tenant share one queue, whatever connection they were received on.
+            priority:       requests of a higher priority are always handled first. Defaults to 0.
+        See the 'deadline', 'tenant' and 'priority' options of BlockingTcpClient.
         '''
         self.address = address
         self.port = port
         self.buffer_size = buffer_size
         self.memoized = memoized
         self.request_handler = request_handler
-        self._saved_responses = {}
+        self.cache = cache if cache is not None else ResponseCache()
+        self.raw_cache_keys = raw_cache_keys
+        self.pending_responses = {}
+        self.coalesced_requests = 0
+        self.metrics = Metrics()
+        self.open_connections = 0
+        self.stats_port = stats_port
+        self.max_queued_requests = max_queued_requests
+        self.backlog = backlog
+        self.connection_slots = Semaphore(max_connections) if max_connections else None
+        self.service_time = None # moving average of the handler latency, in seconds
         self.parallel = parallel
         self.cpus = cpus or cpu_count()
+        self.connection_ids = count()
+        if acceptors > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('acceptors > 1 requires SO_REUSEPORT, which this platform does not support')
+        self.acceptors = acceptors
+        self.binary = binary
+        self.compression_threshold = compression_threshold
+        self.max_frame_size = max_frame_size
+        self.acceptor = 0 # index of the front-end process
+        self.stats_paths = [] # unix sockets the acceptors send their own stats to, see 'gather_stats'
         if parallel:
-            self.requests = Queue()
+            # the flow of the requests of a tenant is ('tenant', tenant), see handle_message
+            self.requests = FairQueue({ ('tenant', tenant): weight for tenant, weight in (tenant_weights or {}).items() })
             self.authkey = token_bytes()
             self.search_path = search_path
-            # tag the socket path with the pid so we can run the multiple servers,
-            # as is the case when running the tests while in a container that runs the official server.
-            self.unix_socket_path = f'/var/run/asynctcp.server.channel.{current_process().pid}'
-            self.channel = Channel(self.unix_socket_path, family=socket.AF_UNIX)
-            self.subprocess_launch_request = Queue(maxsize=self.cpus)
+            self.create_channel()
             self.worker_subprocess_timeout = worker_subprocess_timeout
+            self.max_workers = max_workers or self.cpus
+            self.min_workers = min(min_workers, self.max_workers)
+            self.scale_up_wait = scale_up_wait
+            self.warm_up = warm_up
+            self.preload = preload
+            self.worker_concurrency = worker_concurrency
+            if shared_memory_threshold and SharedMemory is None:
+                LOGGER.warning('multiprocessing.shared_memory is not available, shared_memory_threshold is ignored')
+                shared_memory_threshold = None
+            self.shared_memory_threshold = shared_memory_threshold
+            self.segments = SegmentPool() if shared_memory_threshold else None
+            self.subprocess_launch_request = Queue(maxsize=self.max_workers)
+            self.cold_starts = deque(maxlen=100) # seconds it took to get the most recent worker subprocesses ready
+            self.scale_check = Event() # set when a request is queued or a worker parks, see 'autoscaler'
+            self.scale_up = Queue() # a parked elastic worker wakes up for each item
+            self.parked_workers = 0
+            self.waking_workers = 0
+            self.running_workers = 0
+            self.spawned_workers = 0
+            self.retired_workers = 0
+
+    def create_channel(self):
+        '''
+        Creates the channel the worker subprocesses connect to.
+        '''
+        # tag the socket path with the pid so we can run the multiple servers,
+        # as is the case when running the tests while in a container that runs the official server,
+        # or when running several acceptors.
+        self.unix_socket_path = f'/var/run/asynctcp.server.channel.{current_process().pid}'
+        self.channel = Channel(self.unix_socket_path, family=socket.AF_UNIX)
 
     async def run_client(self, sock, address):
         response_queue = Queue(maxsize=1) if self.parallel else None
+        flow = next(self.connection_ids)
+        self.metrics.increment('connections')
+        self.open_connections += 1
         try:
             async with sock:
-                data_as_str = ''
-                while True:
-                    rawdata = await sock.recv(self.buffer_size)
-                    if not rawdata:
+                rawdata = b''
+                while len(rawdata) < len(MAGIC) and MAGIC.startswith(rawdata):
+                    new_data = await sock.recv(self.buffer_size)
+                    if not new_data:
                         return
-                    data_as_str += rawdata.decode('utf-8').strip()
-                    try:
-                        request = json.loads(data_as_str)
-                    except ValueError:
-                        continue
-                    response = await self.memoized_handler(request, response_queue=response_queue)
-                    data_as_str = ''
-                    await sock.sendall(response.encode('utf-8'))
+                    rawdata += new_data
+                if rawdata.startswith(MAGIC):
+                    await self.run_framed_client(sock, rawdata[len(MAGIC):], response_queue, flow)
+                else:
+                    await self.run_json_client(sock, rawdata, response_queue, flow)
         except CancelledError:
             await sock.close()
+        finally:
+            self.open_connections -= 1
+            if self.connection_slots:
+                await self.connection_slots.release()
 
-    async def memoized_handler(self, request, response_queue=None):
-        if self.memoized:
-            hashable_request = str(request).strip()
-            if hashable_request not in self._saved_responses:
-                if response_queue:
-                    await self.requests.put((response_queue, request))
-                    # next available 'worker' task will put the response on the queue.
-                    self._saved_responses[hashable_request] = await response_queue.get()
-                    await response_queue.task_done()
-                else:
-                    self._saved_responses[hashable_request] = await self.request_handler(request)
-            return self._saved_responses[hashable_request]
+    async def run_json_client(self, sock, rawdata, response_queue, flow):
+        '''
+        Original protocol: a message ends where the JSON text it holds ends.
+        '''
+        messages = JsonReader(self.buffer_size)
+        messages.feed(rawdata)
+        while True:
+            for message in messages:
+                response = await self.handle_message(message, response_queue, flow)
+                await sock.sendall(response)
+            size = await sock.recv_into(messages.writable())
+            if not size:
+                return
+            messages.commit(size)
+
+    async def run_framed_client(self, sock, rawdata, response_queue, flow):
+        '''
+        Framed protocol: the first frame is the client's hello, every following frame is a request.
+        '''
+        frames = FrameReader(buffer_size=self.buffer_size, max_size=self.max_frame_size)
+        frames.feed(rawdata)
+        options = None
+        encoding = None
+        send_lock = Lock()
+        reply_tasks = []
+        try:
+            while True:
+                for request_id, payload in frames:
+                    if options is None:
+                        try:
+                            hello = self.read_hello(payload)
+                        except ValueError as exc:
+                            # the error takes the place of the server's hello, then the connection is closed
+                            LOGGER.error('Invalid hello received: %s', exc)
+                            self.metrics.increment('invalid_requests')
+                            await sock.sendall(hello_frame({'error': 'InvalidRequest', 'message': str(exc)}))
+                            return
+                        options = self.negotiate(hello)
+                        await sock.sendall(hello_frame(options))
+                        if options['multiplexed']:
+                            frames.header = MULTIPLEXED_HEADER
+                        if options['binary'] or options['compression']:
+                            encoding = codec.Encoding(options['binary'], options['compression'], self.compression_threshold)
+                    elif options['multiplexed']:
+                        reply_tasks = [ task for task in reply_tasks if not task.terminated ]
+                        reply_tasks.append( await spawn(self.reply(sock, send_lock, request_id, payload, flow, encoding), daemon=True) )
+                    else:
+                        response = await self.handle_frame(payload, response_queue, flow, encoding)
+                        await sock.sendall(frame(response))
+                size = await sock.recv_into(frames.writable())
+                if not size:
+                    return
+                frames.commit(size)
+        except FrameTooLarge as exc:
+            # the rest of the frame isn't read, so the connection can't be used anymore
+            LOGGER.error('Closing connection: %s', exc)
+            self.metrics.increment('invalid_requests')
+            response = json.dumps({'error': 'InvalidRequest', 'message': str(exc)}).encode('utf-8')
+            if encoding is not None:
+                response = encoding.pack(response)
+            await sock.sendall(frame(response, exc.request_id))
+        finally:
+            for task in reply_tasks:
+                await task.cancel()
+
+    async def reply(self, sock, send_lock, request_id, payload, flow, encoding=None):
+        '''
+        Handles one request of a multiplexed connection and sends the reply, tagged with the request ID.
+        If handling it fails, the reply is an error, so the client isn't left waiting for it.
+        '''
+        try:
+            response = await self.handle_frame(payload, Queue(maxsize=1) if self.parallel else None, flow, encoding)
+        except CancelledError:
+            raise
+        except Exception as exc:
+            LOGGER.exception('Failed to handle request %d', request_id)
+            response = json.dumps({'error': 'InternalError', 'message': repr(exc)}).encode('utf-8')
+            if encoding is not None:
+                response = encoding.pack(response)
+        async with send_lock:
+            await sock.sendall(frame(response, request_id))
+
+    async def handle_frame(self, payload, response_queue, flow, encoding=None):
+        '''
+        Returns the payload of the reply to the payload of a frame, encoded as negotiated, see asynctcp.codec.
+        '''
+        if encoding is None:
+            return await self.handle_message(payload, response_queue, flow)
+        try:
+            message, binary = encoding.unpack(payload)
+        except ValueError as exc:
+            LOGGER.error('Invalid frame received: %s', exc)
+            self.metrics.increment('invalid_requests')
+            response = json.dumps({'error': 'InvalidRequest', 'message': str(exc)}).encode('utf-8')
         else:
-            if response_queue:
-                await self.requests.put((response_queue, request))
-                response = await response_queue.get()
-                await response_queue.task_done()
+            if binary and not encoding.binary:
+                response = json.dumps({'error': 'InvalidRequest', 'message': 'The binary encoding was not negotiated'}).encode('utf-8')
+            else:
+                response = await self.handle_message(message, response_queue, flow, binary)
+        # replies are the JSON text returned by the request handler
+        return encoding.pack(response)
+
+    async def handle_message(self, message, response_queue, flow=None, binary=False):
+        '''
+        Returns the encoded response to a complete message, JSON text unless 'binary' (see asynctcp.codec).
+        'flow' identifies the connection it was received on, see FairQueue.
+        '''
+        start = monotonic()
+        self.metrics.increment('requests')
+        try:
+            request = None
+            deadline = None
+            priority = 0
+            if binary:
+                # requests are decoded before dispatching them, so the binary encoding is decoded here once.
+                request = codec.loads(message)
+            if CONTROL_MARKER in message:
+                if request is None:
+                    request = json.loads(message.decode('utf-8'))
+                if isinstance(request, dict) and isinstance(request.get(CONTROL_KEY), dict):
+                    options = request[CONTROL_KEY]
+                    self.validate_options(options)
+                    if options.get('timeout') is not None:
+                        deadline = start + options['timeout']
+                    if options.get('tenant') is not None:
+                        flow = ('tenant', options['tenant'])
+                    priority = options.get('priority') or 0
+                    request = request.get('request')
+                    # the cache key must not depend on the envelope
+                    message = codec.dumps(request) if binary else json.dumps(request).encode('utf-8')
+                if isinstance(request, dict) and CONTROL_KEY in request:
+                    self.metrics.increment('control_messages')
+                    return self.control(request[CONTROL_KEY])
+            if self.memoized and self.raw_cache_keys:
+                # the message is only decoded if its response isn't cached.
+                response = await self.memoized_handler(
+                    message if request is None else request,
+                    response_queue=response_queue,
+                    key=self.message_key(message, binary),
+                    deadline=deadline,
+                    flow=flow,
+                    priority=priority,
+                )
             else:
-                response = await self.request_handler(request)
+                response = await self.memoized_handler(
+                    json.loads(message.decode('utf-8')) if request is None else request,
+                    response_queue=response_queue,
+                    deadline=deadline,
+                    flow=flow,
+                    priority=priority,
+                )
+        except ValueError as exc:
+            LOGGER.error('Invalid JSON received: %s', exc)
+            self.metrics.increment('invalid_requests')
+            return json.dumps({'error': 'InvalidRequest', 'message': str(exc)}).encode('utf-8')
+        except Overloaded as exc:
+            return json.dumps({'error': 'Overloaded', 'message': str(exc)}).encode('utf-8')
+        self.metrics.observe('request', monotonic() - start)
+        return response
+
+    @staticmethod
+    def validate_options(options):
+        '''
+        Raises ValueError if the options of a request envelope are invalid, so the request is rejected as an InvalidRequest.
+        '''
+        timeout = options.get('timeout')
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))):
+            raise ValueError(f'Invalid timeout: {timeout!r}')
+        priority = options.get('priority')
+        if priority is not None and (isinstance(priority, bool) or not isinstance(priority, int)):
+            raise ValueError(f'Invalid priority: {priority!r}')
+        tenant = options.get('tenant')
+        if tenant is not None and not isinstance(tenant, (str, int)):
+            raise ValueError(f'Invalid tenant: {tenant!r}')
+
+    def control(self, command):
+        '''
+        Returns the encoded reply to a control message, see CONTROL_KEY.
+        '''
+        if command == 'stats':
+            return json.dumps(self.stats()).encode('utf-8')
+        return json.dumps({'error': 'UnknownCommand', 'message': f'Unknown control command: {command}'}).encode('utf-8')
+
+    @staticmethod
+    def message_key(message, binary=False):
+        '''
+        Cache key of a raw message, ignoring the leading and trailing whitespace of JSON text.
+        Whitespace bytes are data in the binary encoding, and binary keys are salted so they never match JSON ones.
+        '''
+        if binary:
+            return blake2b(message, digest_size=16, salt=b'binary').digest()
+        return blake2b(message.strip(), digest_size=16).digest()
+
+    @staticmethod
+    def read_hello(payload):
+        '''
+        Returns the options of a client's hello. Raises ValueError if it isn't a valid hello.
+        '''
+        hello = json.loads(payload.decode('utf-8'))
+        if not isinstance(hello, dict):
+            raise ValueError('The hello must be a JSON object')
+        if not isinstance(hello.get('compression') or [], list):
+            raise ValueError('The compression options of the hello must be a list')
+        return hello
+
+    def negotiate(self, hello):
+        '''
+        Returns the options accepted for a framed connection, given the client's hello.
+        '''
+        return {
+            'framing': PROTOCOL_VERSION,
+            'multiplexed': bool(hello.get('multiplexed')),
+            'binary': self.binary and bool(hello.get('binary')),
+            'compression': self.compression_threshold is not None and 'zlib' in (hello.get('compression') or ()),
+        }
+
+    async def memoized_handler(self, request, response_queue=None, key=None, deadline=None, flow=None, priority=0):
+        '''
+        Returns the utf-8 encoded response to 'request', from the cache if 'memoized' is True.
+        While a response is being computed, identical requests wait for it rather than being dispatched again.
+        'key' overrides the cache key computed from the request. 'request' may then be the raw message,
+        which is only decoded if the response is not cached.
+        'deadline', 'flow' and 'priority' are passed on to 'dispatch'.
+        '''
+        if self.memoized:
+            hashable_request = key if key is not None else str(request).strip()
+            while True:
+                response = self.cache.get(hashable_request)
+                if response is not None:
+                    return response
+                pending = self.pending_responses.get(hashable_request)
+                if pending is None:
+                    break
+                self.coalesced_requests += 1
+                response = await pending.wait()
+                if response is not None:
+                    return response
+                # computing the response failed for the request we waited on, so try again.
+            pending = self.pending_responses[hashable_request] = PendingResponse()
+            response = None
+            try:
+                response = await self.dispatch(request, response_queue, deadline, flow, priority)
+                self.cache.put(hashable_request, response)
+            finally:
+                del self.pending_responses[hashable_request]
+                await pending.finish(response)
+            return response
+        else:
+            return await self.dispatch(request, response_queue, deadline, flow, priority)
+
+    async def dispatch(self, request, response_queue=None, deadline=None, flow=None, priority=0):
+        '''
+        Returns the utf-8 encoded response of the request handler.
+        With 'parallel', the request is queued for a worker in the queue of its 'flow' and 'priority' (see FairQueue).
+        Raises Overloaded rather than queue the request if the queue is full,
+        or if the 'deadline' (see time.monotonic) would pass before a worker is available.
+        '''
+        if isinstance(request, (bytes, bytearray)):
+            request = json.loads(request.decode('utf-8'))
+        if response_queue:
+            self.admit(deadline)
+            await self.requests.put((response_queue, request, deadline), flow, priority)
+            await self.scale_check.set()
+            # next available 'worker' task will put the response on the queue.
+            response = await response_queue.get()
+            await response_queue.task_done()
+            if isinstance(response, Overloaded):
+                raise response
+        else:
+            start = monotonic()
+            response = await self.request_handler(request)
+            self.metrics.observe('handler', monotonic() - start)
+        if isinstance(response, bytes):
+            # read from shared memory
             return response
+        return response.encode('utf-8')
+
+    def admit(self, deadline):
+        '''
+        Raises Overloaded if a request with this 'deadline' should not be queued.
+        '''
+        queued = len(self.requests)
+        if self.max_queued_requests is not None and queued >= self.max_queued_requests:
+            self.metrics.increment('rejected_requests')
+            raise Overloaded(f'{queued} requests already queued')
+        if deadline is not None and self.service_time is not None:
+            # each worker takes a request off the queue every 'service_time' seconds, on average
+            expected_wait = (queued + 1) * self.service_time / (self.max_workers * self.worker_concurrency)
+            if monotonic() + expected_wait > deadline:
+                self.metrics.increment('rejected_requests')
+                raise Overloaded(f'expected to wait {expected_wait:.3f} seconds for a worker')
+
+    def stats(self):
+        stats = {
+            'acceptor': self.acceptor,
+            'cache': self.cache.stats() if self.memoized else None,
+            'coalesced_requests': self.coalesced_requests,
+            'pending_responses': len(self.pending_responses),
+            'open_connections': self.open_connections,
+            'metrics': self.metrics.snapshot(),
+        }
+        if self.parallel:
+            stats['workers'] = {
+                'min': self.min_workers,
+                'max': self.max_workers,
+                'running': self.running_workers,
+                'parked': self.parked_workers,
+                'spawned': self.spawned_workers,
+                'retired': self.retired_workers,
+                'queued_requests': len(self.requests),
+                'queue': self.requests.stats(),
+                'max_queued_requests': self.max_queued_requests,
+                'service_time': self.service_time,
+                'cold_start': {
+                    'last': self.cold_starts[-1] if self.cold_starts else None,
+                    'mean': sum(self.cold_starts) / len(self.cold_starts) if self.cold_starts else None,
+                    'max': max(self.cold_starts, default=None),
+                },
+            }
+        return stats
+
+    async def next_request(self):
+        enqueued_at, item = await self.requests.get()
+        self.metrics.observe('queue_wait', monotonic() - enqueued_at)
+        return item
 
     async def worker(self, id, subprocess_timeout=5):
         '''
         There is exactly one 'worker' task per subprocess.
         This is the link between one client connection and one subprocess.
-        It waits for a (response_queue, request) from the 'self.requests' queue,
-        sends the request to the subprocess,
-        waits to receive the response and puts it in the client's response queue.
+        It waits for a (response_queue, request, deadline) from the 'self.requests' queue,
+        replies with an Overloaded error instead if the deadline has passed,
+        sends the request to the subprocess, tagged so its response can be matched,
+        and keeps up to 'worker_concurrency' requests in flight.
+        A 'receive_responses' task puts each response in the client's response queue.
 
         The subprocess is started on-demand, so as not to consume CPU and memory when the server is idle.
+        The first 'min_workers' workers keep their subprocess once it is started, at server start if 'warm_up' is True.
+        The other workers are elastic: they stay parked until the 'autoscaler' task wakes them up,
+        and shut their subprocess down when no request was queued up for 'subprocess_timeout' seconds.
         '''
+        warm = id < self.min_workers
         subprocess_task = None
         subprocess_connection = None
+        receiver_task = None
         subprocess_launch_response = Queue(maxsize=1) # receives the (connection, task) for a requested worker subprocess
+        slots = Semaphore(self.worker_concurrency)
+        send_lock = Lock() # requests are sent by this task, and release messages by the 'receive_responses' task
+        in_flight = {} # tag -> (response queue, time the request was sent to the subprocess, shared memory segment name)
+        tags = count()
         try:
+            if warm and self.warm_up:
+                subprocess_connection, subprocess_task = await self.launch_subprocess(id, subprocess_launch_response)
+                receiver_task = await spawn(self.receive_responses(subprocess_connection, in_flight, slots, send_lock))
             while True:
-                if subprocess_connection:
+                await slots.acquire()
+                if warm:
+                    response_queue, request, deadline = await self.next_request()
+                else:
+                    waking = not subprocess_connection
+                    if waking:
+                        self.parked_workers += 1
+                        await self.scale_check.set()
+                        await self.scale_up.get()
                     try:
-                        response_queue, request = await timeout_after(subprocess_timeout, self.requests.get())
+                        response_queue, request, deadline = await timeout_after(subprocess_timeout, self.next_request())
                     except TaskTimeout:
-                        await subprocess_task.cancel()
-                        await subprocess_connection.close()
-                        subprocess_connection = None
-                        subprocess_task = None
+                        await slots.release()
+                        if waking:
+                            self.waking_workers -= 1
+                        elif not in_flight:
+                            await receiver_task.cancel()
+                            await self.retire_subprocess(subprocess_connection, subprocess_task)
+                            subprocess_connection = None
+                            subprocess_task = None
                         continue
-                else:
-                    response_queue, request = await self.requests.get()
-                    await self.subprocess_launch_request.put((id, subprocess_launch_response))
-                    subprocess_connection, subprocess_task = await subprocess_launch_response.get()
-                await subprocess_connection.send(request)
-                response = await subprocess_connection.recv()
-                await response_queue.put(response)
-                await self.requests.task_done()
+                    if waking:
+                        self.waking_workers -= 1
+                if deadline is not None and monotonic() > deadline:
+                    # the client stopped waiting for this reply
+                    self.metrics.increment('expired_requests')
+                    await response_queue.put(Overloaded('the request expired while queued'))
+                    await slots.release()
+                    continue
+                if not subprocess_connection:
+                    subprocess_connection, subprocess_task = await self.launch_subprocess(id, subprocess_launch_response)
+                    receiver_task = await spawn(self.receive_responses(subprocess_connection, in_flight, slots, send_lock))
+                tag = next(tags)
+                async with send_lock:
+                    in_flight[tag] = (response_queue, monotonic(), await self.send_request(subprocess_connection, tag, request))
         except CancelledError:
+            if receiver_task:
+                await receiver_task.cancel()
             if subprocess_task:
                 await subprocess_task.cancel()
             if subprocess_connection:
                 await subprocess_connection.close()
 
+    async def send_request(self, subprocess_connection, tag, request):
+        '''
+        Sends a tagged request to a worker subprocess.
+        Returns the name of the shared memory segment holding the request, if it was large enough to use one.
+        '''
+        if not self.shared_memory_threshold:
+            await subprocess_connection.send((tag, request))
+            return
+        message = pickle.dumps((tag, request), pickle.HIGHEST_PROTOCOL)
+        if len(message) < self.shared_memory_threshold:
+            # same as 'send', without pickling twice
+            await subprocess_connection.send_bytes(message)
+            return
+        payload = self.segments.put(message)
+        self.metrics.increment('shared_memory_requests')
+        await subprocess_connection.send(payload)
+        return payload.name
+
+    async def receive_responses(self, subprocess_connection, in_flight, slots, send_lock):
+        '''
+        Puts each response received from a worker subprocess in the response queue of its request.
+        '''
+        attachments = Attachments() if self.shared_memory_threshold else None
+        try:
+            while True:
+                tag, response, handler_latency = await subprocess_connection.recv()
+                response_queue, sent_at, segment_name = in_flight.pop(tag)
+                if segment_name:
+                    self.segments.release(segment_name)
+                if isinstance(response, SharedPayload):
+                    self.metrics.increment('shared_memory_responses')
+                    segment_name, response = response.name, attachments.read(response)
+                    async with send_lock:
+                        await subprocess_connection.send((None, segment_name))
+                self.metrics.observe('worker_round_trip', monotonic() - sent_at)
+                self.metrics.observe('handler', handler_latency)
+                if self.service_time is None:
+                    self.service_time = handler_latency
+                else:
+                    self.service_time += SERVICE_TIME_SMOOTHING * (handler_latency - self.service_time)
+                await response_queue.put(response)
+                await slots.release()
+        finally:
+            if attachments:
+                attachments.close()
+
+    async def launch_subprocess(self, id, subprocess_launch_response):
+        await self.subprocess_launch_request.put((id, subprocess_launch_response))
+        subprocess = await subprocess_launch_response.get()
+        self.running_workers += 1
+        self.spawned_workers += 1
+        return subprocess
+
+    async def retire_subprocess(self, subprocess_connection, subprocess_task):
+        await subprocess_task.cancel()
+        await subprocess_connection.close()
+        self.running_workers -= 1
+        self.retired_workers += 1
+
+    async def autoscaler(self):
+        '''
+        Wakes up a parked elastic 'worker' task whenever the oldest queued request has waited for 'scale_up_wait' seconds,
+        unless enough workers are already waking up to take all the queued requests.
+        Otherwise, it sleeps until a request is queued or a worker parks, rather than poll an idle or saturated server.
+        '''
+        while True:
+            oldest = self.requests.oldest()
+            waited = None if oldest is None else monotonic() - oldest
+            if waited is not None and waited < self.scale_up_wait:
+                await sleep(self.scale_up_wait - waited)
+            elif waited is not None and self.parked_workers and len(self.requests) > self.waking_workers:
+                self.parked_workers -= 1
+                self.waking_workers += 1
+                await self.scale_up.put(None)
+            else:
+                self.scale_check.clear()
+                await self.scale_check.wait()
+
     async def subprocess_launcher(self):
         '''
         Launches a subprocess whenever a 'worker' task requests it.
+        With 'preload', subprocesses are forked from the worker template instead of started from scratch.
         '''
+        template = WorkerTemplate(
+            self.channel,
+            self.authkey,
+            self.request_handler,
+            self.search_path,
+            self.worker_concurrency,
+            self.shared_memory_threshold,
+        ) if self.preload else None
         async with self.channel:
             while True:
                 try:
                     worker_id, response = await self.subprocess_launch_request.get()
-                    subprocess_task = await aside(
-                        worker_main,
-                        worker_id,
-                        self.channel,
-                        self.authkey,
-                        self.request_handler,
-                        self.search_path
-                    )
+                    start = monotonic()
+                    if template:
+                        subprocess_task = await template.fork(worker_id)
+                    else:
+                        subprocess_task = await aside(
+                            worker_main,
+                            worker_id,
+                            self.channel,
+                            self.authkey,
+                            self.request_handler,
+                            self.search_path,
+                            False,
+                            self.worker_concurrency,
+                            self.shared_memory_threshold,
+                        )
                     subprocess_connection = await self.channel.accept(authkey=self.authkey)
+                    self.cold_starts.append(monotonic() - start)
+                    self.metrics.observe('worker_cold_start', self.cold_starts[-1])
+                    LOGGER.info('Worker subprocess %d ready in %f seconds', worker_id, self.cold_starts[-1])
                     await response.put((subprocess_connection, subprocess_task))
                 except CancelledError:
                     break
+        if template:
+            await template.close()
+
+    async def run_stats_server(self):
+        '''
+        Sends the server stats to every connection made to the 'stats_port', then closes it.
+        With several acceptors, only the first one listens on the 'stats_port', and sends the stats of all of them.
+        '''
+        async with curiosocket.socket(curiosocket.AF_INET, curiosocket.SOCK_STREAM) as listening_socket:
+            listening_socket.setsockopt(curiosocket.SOL_SOCKET, curiosocket.SO_REUSEADDR, True)
+            listening_socket.bind(('127.0.0.1', self.stats_port))
+            listening_socket.listen(5)
+            while True:
+                client_socket, _ = await listening_socket.accept()
+                async with client_socket:
+                    stats = {'acceptors': await self.gather_stats()} if self.acceptors > 1 else self.stats()
+                    await client_socket.sendall(json.dumps(stats).encode('utf-8'))
+
+    async def run_acceptor_stats_server(self):
+        '''
+        Sends the stats of this acceptor to every connection made to its stats socket, for the first acceptor to gather them.
+        '''
+        path = self.stats_paths[self.acceptor]
+        if exists(path):
+            remove(path)
+        try:
+            async with curiosocket.socket(curiosocket.AF_UNIX, curiosocket.SOCK_STREAM) as listening_socket:
+                listening_socket.bind(path)
+                listening_socket.listen(5)
+                while True:
+                    client_socket, _ = await listening_socket.accept()
+                    async with client_socket:
+                        await client_socket.sendall(json.dumps(self.stats()).encode('utf-8'))
+        finally:
+            if exists(path):
+                remove(path)
+
+    async def gather_stats(self):
+        '''
+        Returns the stats of every acceptor, in order. Those of an acceptor that doesn't reply are an error.
+        '''
+        stats = []
+        for index, path in enumerate(self.stats_paths):
+            if index == self.acceptor:
+                stats.append(self.stats())
+                continue
+            try:
+                async with timeout_after(1):
+                    async with await open_unix_connection(path) as stats_socket:
+                        data = b''
+                        while True:
+                            chunk = await stats_socket.recv(1 << 16)
+                            if not chunk:
+                                break
+                            data += chunk
+                stats.append(json.loads(data.decode('utf-8')))
+            except (OSError, TaskTimeout, ValueError) as exc:
+                LOGGER.warning('Failed to get the stats of acceptor %d: %r', index, exc)
+                stats.append({'acceptor': index, 'error': repr(exc)})
+        return stats
 
     async def run_server(self):
+        stats_server_task = None
+        acceptor_stats_server_task = None
         try:
+            if self.stats_port:
+                if self.acceptors > 1:
+                    acceptor_stats_server_task = await spawn(self.run_acceptor_stats_server())
+                if self.acceptor == 0:
+                    stats_server_task = await spawn(self.run_stats_server())
             if self.parallel:
                 subprocess_launcher_task = await spawn(self.subprocess_launcher())
-                worker_tasks = []
-                for id in range(self.cpus):
+                worker_tasks = [ await spawn(self.autoscaler()) ]
+                for id in range(self.max_workers):
                     worker_tasks.append( await spawn(self.worker(id, self.worker_subprocess_timeout)) )
             async with curiosocket.socket(curiosocket.AF_INET, curiosocket.SOCK_STREAM) as listening_socket:
                 listening_socket.setsockopt(curiosocket.SOL_SOCKET, curiosocket.SO_REUSEADDR, True)
+                if self.acceptors > 1:
+                    # the kernel spreads the incoming connections over the acceptors
+                    listening_socket.setsockopt(curiosocket.SOL_SOCKET, socket.SO_REUSEPORT, True)
                 listening_socket.bind((self.address, self.port))
-                listening_socket.listen(100)
+                listening_socket.listen(self.backlog)
                 while True:
+                    if self.connection_slots:
+                        await self.connection_slots.acquire()
                     client_socket, remote_address = await listening_socket.accept()
                     await spawn(self.run_graceful_client(client_socket, remote_address))
         except CancelledError:
+            if stats_server_task:
+                await stats_server_task.cancel()
+            if acceptor_stats_server_task:
+                await acceptor_stats_server_task.cancel()
             if self.parallel:
                 await wait(worker_tasks).cancel_remaining()
                 await subprocess_launcher_task.cancel()
+                if self.segments:
+                    self.segments.close()
                 if exists(self.unix_socket_path):
                     remove(self.unix_socket_path)
 
@@ -263,6 +1072,38 @@ class AsyncTcpCallbackServer(object):
         await server_task.cancel()
 
     def run(self):
+        if self.acceptors > 1:
+            return self.run_acceptors()
+        with catch_warnings():
+            filterwarnings('ignore', category=DeprecationWarning)
+            return run(self.run_graceful_server())
+
+    def run_acceptors(self):
+        '''
+        Runs the server in 'acceptors' forked front-end processes, until this process gets SIGINT or SIGTERM.
+        '''
+        self.stats_paths = [ f'/var/run/asynctcp.server.stats.{current_process().pid}.{index}' for index in range(self.acceptors) ]
+        processes = [
+            get_context('fork').Process(target=self.run_acceptor, args=(index,), name=f'{current_process().name}.acceptor.{index}')
+            for index in range(self.acceptors)
+        ]
+        def terminate(signal_number, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        signal(SIGINT, terminate)
+        signal(SIGTERM, terminate)
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def run_acceptor(self, index):
+        signal(SIGINT, SIG_DFL)
+        signal(SIGTERM, SIG_DFL)
+        self.acceptor = index
+        if self.parallel:
+            self.create_channel()
         with catch_warnings():
             filterwarnings('ignore', category=DeprecationWarning)
             return run(self.run_graceful_server())
@@ -270,15 +1111,97 @@ class AsyncTcpCallbackServer(object):
 
 class BlockingTcpClient(object):
 
-    def __init__(self, host = 'localhost', port = 25252, json = True, timeout = 5, buffer_size = 1 << 13):
+    def __init__(
+        self,
+        host = 'localhost',
+        port = 25252,
+        json = True,
+        timeout = 5,
+        buffer_size = 1 << 13,
+        framed = False,
+        multiplexed = False,
+        deadline = False,
+        tenant = None,
+        priority = None,
+        binary = False,
+        compression_threshold = None,
+    ):
+        '''
+            framed:     if True, negotiate the framed protocol with the server.
+                        Falls back to the original protocol if the server does not support it.
+            multiplexed: if True, negotiate a multiplexed framed connection (implies 'framed').
+                        Many requests can then be in flight at once, see 'submit' and 'send_many'.
+            deadline:   if True, every request tells the server the client waits 'timeout' seconds for its reply,
+                        so an overloaded server replies with an 'Overloaded' error or drops the request
+                        instead of handling it after the client gave up.
+            tenant:     if set, the server queues the requests of all the clients of this tenant together,
+                        so they share the workers fairly with other tenants and connections.
+            priority:   if set, the priority class of the requests. The server handles higher priorities first.
+            binary:     if True, negotiate the binary encoding of asynctcp.codec (implies 'framed').
+                        Requests passed to 'send' as objects rather than JSON text are then binary encoded,
+                        and their bytes values reach the request handler as bytes.
+                        Otherwise, they are sent as JSON, with bytes values base64 encoded.
+            compression_threshold: if set, negotiate compression (implies 'framed'),
+                        and compress the requests of at least that many bytes.
+        '''
         self.json = json
         self.host = host
         self.port = port
+        self.timeout = timeout
+        self.deadline = deadline
+        self.tenant = tenant
+        self.priority = priority
         self.buffer_size = buffer_size
-        self.socket = socket.create_connection((host, port), timeout = 3)
-        self.socket.settimeout(timeout)
         if not json:
             raise NotImplementedError('Non JSON version not implemented')
+        self.binary = binary
+        self.compression_threshold = compression_threshold
+        self.socket = self.connect()
+        self.messages = JsonReader(buffer_size)
+        self.multiplexed = False
+        self.encoding = None
+        self.framed = (framed or multiplexed or binary or compression_threshold is not None) and self.negotiate(multiplexed)
+        if self.multiplexed:
+            # replies are read by a dedicated thread, timeouts are enforced on each request's future instead
+            self.socket.settimeout(None)
+            self._lock = ThreadLock()
+            self._request_ids = count(1)
+            self._pending = {}
+            self._reader = None
+
+    def connect(self):
+        connection = socket.create_connection((self.host, self.port), timeout = 3)
+        connection.settimeout(self.timeout)
+        return connection
+
+    def negotiate(self, multiplexed = False):
+        '''
+        Returns True if the server accepted the framed protocol.
+        Otherwise, reconnects so the original protocol can be used on a clean connection.
+        '''
+        self.socket.settimeout(NEGOTIATION_TIMEOUT)
+        try:
+            self.socket.sendall(hello_frame({
+                'framing': PROTOCOL_VERSION,
+                'multiplexed': multiplexed,
+                'binary': self.binary,
+                'compression': ['zlib'] if self.compression_threshold is not None else [],
+            }))
+            if self.recv_exactly(len(MAGIC)) == MAGIC:
+                options = self.read_frame()
+                if options and options.get('framing') == PROTOCOL_VERSION:
+                    self.multiplexed = bool(options.get('multiplexed'))
+                    if options.get('binary') or options.get('compression'):
+                        self.encoding = codec.Encoding(bool(options.get('binary')), bool(options.get('compression')), self.compression_threshold)
+                    self.socket.settimeout(self.timeout)
+                    return True
+        except (socket.timeout, OSError, ValueError):
+            pass
+        LOGGER.warning('Server at {}:{} does not support the framed protocol'.format(self.host, self.port))
+        self.close()
+        self.socket = self.connect()
+        self.messages = JsonReader(self.buffer_size)
+        return False
 
     def close(self):
         with suppress(Exception):
@@ -286,28 +1209,404 @@ class BlockingTcpClient(object):
         with suppress(Exception):
             self.socket.close()
 
+    def recv_exactly(self, size):
+        '''
+        Receives exactly 'size' bytes directly into a single buffer. Returns None if the connection was closed.
+        '''
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            chunk_size = self.socket.recv_into(view[received:], size - received)
+            if not chunk_size:
+                return
+            received += chunk_size
+        return buffer
+
+    def read_frame(self):
+        '''
+        Returns the decoded payload of the next frame, or (request ID, decoded payload) on a multiplexed connection.
+        Raises ConnectionError if the server closed the connection.
+        '''
+        header = MULTIPLEXED_HEADER if self.multiplexed else HEADER
+        raw_header = self.recv_exactly(header.size)
+        if raw_header is None:
+            raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+        *request_id, size = header.unpack(raw_header)
+        payload = self.recv_exactly(size)
+        if payload is None:
+            raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+        if self.encoding is not None:
+            payload, _ = self.encoding.unpack(payload)
+        response = json.loads(payload.decode('utf-8'))
+        return (request_id[0], response) if self.multiplexed else response
+
     def read(self):
-        response = ''
+        '''
+        Returns the decoded reply, which is None if the handler failed. Raises ConnectionError if the server closed the connection.
+        '''
+        if self.framed:
+            return self.read_frame()
         while True:
-            new_data = self.socket.recv(self.buffer_size).decode('utf-8')
-            if not new_data:
-                return
-            try:
-                response += new_data
-                response_as_object = json.loads(response)
-                break
-            except ValueError:
-                continue
-        return response_as_object
+            for message in self.messages:
+                return json.loads(message.decode('utf-8'))
+            size = self.socket.recv_into(self.messages.writable())
+            if not size:
+                raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+            self.messages.commit(size)
+
+    def read_replies(self):
+        '''
+        Runs in the reader thread of a multiplexed client. Resolves the future of each request as its reply arrives.
+        '''
+        try:
+            while True:
+                request_id, response = self.read_frame()
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future:
+                    future.set_result(response)
+        except Exception as exc:
+            error = exc
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._reader = None
+        for future in pending.values():
+            future.set_exception(error)
+
+    def submit(self, data):
+        '''
+        Sends a request on a multiplexed connection without waiting for its reply.
+        Returns a concurrent.futures.Future resolved with the decoded reply.
+        '''
+        if not self.multiplexed:
+            raise ValueError('submit requires a multiplexed connection')
+        future = Future()
+        with self._lock:
+            request_id = next(self._request_ids) & 0xffffffff
+            self._pending[request_id] = future
+            if self._reader is None:
+                self._reader = Thread(target=self.read_replies, name='BlockingTcpClient.read_replies', daemon=True)
+                self._reader.start()
+            self.socket.sendall(frame(self.encode(data), request_id))
+        future.request_id = request_id
+        return future
+
+    def result(self, future):
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._pending.pop(future.request_id, None)
+            LOGGER.error('Socket timeout trying to read from {}:{}'.format(self.host, self.port))
+            raise socket.timeout('timed out')
 
     def send(self, data):
-        self.socket.sendall(data.encode('utf-8'))
+        if self.multiplexed:
+            return self.result(self.submit(data))
+        if self.framed:
+            self.socket.sendall(frame(self.encode(data)))
+        else:
+            if not isinstance(data, str):
+                data = json.dumps(data, default = codec.json_default)
+            self.socket.sendall(self.envelope(data).encode('utf-8'))
         try:
             return self.read()
         except socket.timeout as exc:
             LOGGER.error('Socket timeout trying to read from {}:{}'.format(self.host, self.port))
             raise exc
 
+    def envelope_options(self):
+        options = {}
+        if self.deadline and self.timeout is not None:
+            options['timeout'] = self.timeout
+        if self.tenant is not None:
+            options['tenant'] = self.tenant
+        if self.priority is not None:
+            options['priority'] = self.priority
+        return options
+
+    def envelope(self, data):
+        '''
+        Wraps the JSON text 'data' in an envelope carrying the client's 'timeout', 'tenant' and 'priority', if set.
+        '''
+        options = self.envelope_options()
+        if not options:
+            return data
+        return '{"%s": %s, "request": %s}' % (CONTROL_KEY, json.dumps(options), data)
+
+    def encode(self, data):
+        '''
+        Returns the payload of the frame of a request, given as JSON text or as an object.
+        '''
+        if not isinstance(data, str):
+            if self.encoding is not None and self.encoding.binary:
+                options = self.envelope_options()
+                return self.encoding.pack(codec.dumps({CONTROL_KEY: options, 'request': data} if options else data), binary = True)
+            data = json.dumps(data, default = codec.json_default)
+        payload = self.envelope(data).encode('utf-8')
+        if self.encoding is not None:
+            return self.encoding.pack(payload)
+        return payload
+
+    def send_many(self, requests):
+        '''
+        Returns the replies to all 'requests', in the same order.
+        On a multiplexed connection, all the requests are in flight at once and may be handled in parallel by the server.
+        '''
+        if not self.multiplexed:
+            return [ self.send(data) for data in requests ]
+        futures = [ self.submit(data) for data in requests ]
+        return [ self.result(future) for future in futures ]
+
+    def stats(self):
+        '''
+        Returns the stats of the server, see AsyncTcpCallbackServer.stats.
+        '''
+        return self.send(json.dumps({CONTROL_KEY: 'stats'}))
+
+class AsyncTcpClient(object):
+    '''
+    Client of an AsyncTcpCallbackServer for curio tasks, such as the handlers of another AsyncTcpCallbackServer,
+    with the same protocols and options as BlockingTcpClient, including the binary encoding and compression of asynctcp.codec.
+    The connection is opened on the first request and reused by the following ones.
+    It is reopened if the server closed it, or if a request timed out on a connection that isn't multiplexed,
+    since its reply could otherwise be taken for the reply to the next request.
+    On a multiplexed connection, any number of tasks may send requests at once, and replies are read by a dedicated task.
+    Otherwise, concurrent requests are sent one at a time.
+
+        async with AsyncTcpClient(port = 25252, multiplexed = True) as client:
+            replies = await client.send_many(requests)
+    '''
+    def __init__(
+        self,
+        host = 'localhost',
+        port = 25252,
+        timeout = 5,
+        buffer_size = 1 << 13,
+        framed = False,
+        multiplexed = False,
+        deadline = False,
+        tenant = None,
+        priority = None,
+        binary = False,
+        compression_threshold = None,
+    ):
+        '''
+        See BlockingTcpClient. 'timeout' bounds the wait for each reply, TaskTimeout is raised rather than socket.timeout.
+        '''
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.framed = framed or multiplexed or binary or compression_threshold is not None
+        self.multiplexed = multiplexed
+        self.deadline = deadline
+        self.tenant = tenant
+        self.priority = priority
+        self.binary = binary
+        self.compression_threshold = compression_threshold
+        self.socket = None
+        self.lock = Lock()
+
+    envelope_options = BlockingTcpClient.envelope_options
+    envelope = BlockingTcpClient.envelope
+    encode = BlockingTcpClient.encode
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def connect(self):
+        self.socket = await timeout_after(NEGOTIATION_TIMEOUT, curiosocket.create_connection((self.host, self.port)))
+        self.messages = JsonReader(self.buffer_size)
+        self.frames = FrameReader(buffer_size=self.buffer_size)
+        self.connected_framed = False
+        self.connected_multiplexed = False
+        self.encoding = None
+        if self.framed and not await self.negotiate():
+            await self.socket.close()
+            self.socket = await timeout_after(NEGOTIATION_TIMEOUT, curiosocket.create_connection((self.host, self.port)))
+        if self.connected_multiplexed:
+            self.frames.header = MULTIPLEXED_HEADER
+            self.request_ids = count(1)
+            self.pending = {}
+            self.reader = await spawn(self.read_replies(self.socket), daemon=True)
+
+    async def negotiate(self):
+        '''
+        Returns True if the server accepted the framed protocol.
+        '''
+        try:
+            async with timeout_after(NEGOTIATION_TIMEOUT):
+                await self.socket.sendall(hello_frame({
+                    'framing': PROTOCOL_VERSION,
+                    'multiplexed': self.multiplexed,
+                    'binary': self.binary,
+                    'compression': ['zlib'] if self.compression_threshold is not None else [],
+                }))
+                magic = b''
+                while len(magic) < len(MAGIC):
+                    data = await self.socket.recv(len(MAGIC) - len(magic))
+                    if not data:
+                        break
+                    magic += data
+                if magic == MAGIC:
+                    _, payload = await self.read_frame()
+                    options = json.loads(payload.decode('utf-8'))
+                    if options.get('framing') == PROTOCOL_VERSION:
+                        self.connected_framed = True
+                        self.connected_multiplexed = bool(options.get('multiplexed'))
+                        if options.get('binary') or options.get('compression'):
+                            self.encoding = codec.Encoding(bool(options.get('binary')), bool(options.get('compression')), self.compression_threshold)
+                        return True
+        except (TaskTimeout, OSError, ValueError):
+            pass
+        LOGGER.warning('Server at {}:{} does not support the framed protocol'.format(self.host, self.port))
+        return False
+
+    async def close(self):
+        if self.socket is None:
+            return
+        sock, self.socket = self.socket, None
+        if self.connected_multiplexed:
+            await self.reader.cancel()
+        with suppress(Exception):
+            await sock.close()
+
+    async def receive(self, reader):
+        size = await self.socket.recv_into(reader.writable())
+        if not size:
+            raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+        reader.commit(size)
+
+    async def read_frame(self):
+        '''
+        Returns the (request ID, payload) of the next frame.
+        '''
+        while True:
+            for request_id, payload in self.frames:
+                return request_id, payload
+            await self.receive(self.frames)
+
+    async def read(self):
+        if self.connected_framed:
+            return (await self.read_frame())[1]
+        while True:
+            for message in self.messages:
+                return message
+            await self.receive(self.messages)
+
+    def decode(self, payload):
+        '''
+        Returns the decoded reply of a message or frame payload.
+        '''
+        if self.encoding is not None:
+            payload, _ = self.encoding.unpack(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    async def read_replies(self, sock):
+        '''
+        Runs as a task on a multiplexed connection. Resolves the pending request of each reply as it arrives.
+        '''
+        try:
+            while True:
+                request_id, payload = await self.read_frame()
+                pending = self.pending.pop(request_id, None)
+                if pending:
+                    await pending.finish(payload)
+        except CancelledError:
+            raise
+        except Exception as exc:
+            LOGGER.warning('Connection to {}:{} lost: {}'.format(self.host, self.port, exc))
+        finally:
+            pending, self.pending = self.pending, {}
+            if self.socket is sock:
+                # the next request reconnects
+                self.socket = None
+                with suppress(Exception):
+                    await sock.close()
+            for request in pending.values():
+                await request.finish()
+
+    async def ensure_connected(self):
+        if self.socket is None:
+            async with self.lock:
+                if self.socket is None:
+                    await self.connect()
+
+    async def submit(self, data):
+        '''
+        Sends a request on a multiplexed connection without waiting for its reply. Returns the request to pass to 'result'.
+        '''
+        await self.ensure_connected()
+        if not self.connected_multiplexed:
+            raise ValueError('submit requires a multiplexed connection')
+        request = PendingResponse()
+        request.id = next(self.request_ids) & 0xffffffff
+        async with self.lock:
+            if self.socket is None:
+                raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+            self.pending[request.id] = request
+            await self.socket.sendall(frame(self.encode(data), request.id))
+        return request
+
+    async def result(self, request):
+        '''
+        Returns the decoded reply to a request returned by 'submit'.
+        '''
+        try:
+            payload = await timeout_after(self.timeout, request.wait())
+        except TaskTimeout:
+            self.pending.pop(request.id, None)
+            LOGGER.error('Timeout trying to read from {}:{}'.format(self.host, self.port))
+            raise
+        if payload is None:
+            raise ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+        return self.decode(payload)
+
+    async def send(self, data):
+        await self.ensure_connected()
+        if self.connected_multiplexed:
+            return await self.result(await self.submit(data))
+        async with self.lock:
+            if self.socket is None:
+                await self.connect()
+            if self.connected_framed:
+                data = frame(self.encode(data))
+            else:
+                if not isinstance(data, str):
+                    data = json.dumps(data, default = codec.json_default)
+                data = self.envelope(data).encode('utf-8')
+            try:
+                async with timeout_after(self.timeout):
+                    await self.socket.sendall(data)
+                    message = await self.read()
+            except (TaskTimeout, OSError) as exc:
+                LOGGER.error('Failed to read from {}:{}: {!r}'.format(self.host, self.port, exc))
+                await self.close()
+                raise
+        return self.decode(message)
+
+    async def send_many(self, requests):
+        '''
+        Returns the replies to all 'requests', in the same order.
+        On a multiplexed connection, all the requests are in flight at once and may be handled in parallel by the server.
+        '''
+        await self.ensure_connected()
+        if not self.connected_multiplexed:
+            return [ await self.send(data) for data in requests ]
+        submitted = [ await self.submit(data) for data in requests ]
+        return [ await self.result(request) for request in submitted ]
+
+    async def stats(self):
+        '''
+        Returns the stats of the server, see AsyncTcpCallbackServer.stats.
+        '''
+        return await self.send(json.dumps({CONTROL_KEY: 'stats'}))
+
 # if __name__ == '__main__':
 #     async def callback(data):
 #         print('returning {}'.format(str(data)))
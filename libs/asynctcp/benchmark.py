@@ -0,0 +1,392 @@
+'''
+Benchmarks of the asynctcp package.
+
+    python -m asynctcp.benchmark receive [--size BYTES] [--chunk BYTES] [--repeat N]
+
+measures the CPU time and peak memory it takes to turn the chunks received for one message into the decoded request,
+for the original string concatenation loop and for the buffer based readers of asynctcp.protocol.
+
+    python -m asynctcp.benchmark codec [--size BYTES] [--repeat N]
+
+measures the size on the wire of a parser request carrying 'size' bytes of source code,
+and the CPU time it takes to encode it on the client and decode it on the server,
+as JSON with the code base64 encoded, and with the binary encoding of asynctcp.codec, uncompressed and compressed.
+
+    python -m asynctcp.benchmark load [--handler echo cpu sleep] [--connections N ...] [--payload BYTES ...]
+                                      [--workers N ...] [--memoized off on] [--duration SECONDS] [--output FILE]
+
+runs a local AsyncTcpCallbackServer for every combination of the given parameters and loads it
+from one client process per connection, each sending its next request as soon as it gets a reply.
+It reports the throughput and latency percentiles of every scenario and, with '--output',
+writes them as JSON so runs of different versions can be compared.
+A worker count of 0 runs the server with 'parallel' set to False.
+'''
+from argparse import ArgumentParser
+import base64
+from datetime import datetime, timezone
+from itertools import product
+import json
+from multiprocessing import cpu_count, Event, Pipe, Process
+from os import urandom
+from os.path import abspath, dirname
+import platform
+import socket
+from time import perf_counter, sleep
+import tracemalloc
+
+import curio
+
+from . import codec
+from .asynctcp import AsyncTcpCallbackServer, BlockingTcpClient
+from .protocol import frame, FrameReader, JsonReader
+
+
+CPU_BOUND_ITERATIONS = 20000 # about 1ms of work on a recent core
+
+SLEEP_DURATION = .01
+
+SERVER_START_TIMEOUT = 10
+
+
+def original_receive(message, chunk_size):
+    '''
+    The receive loop of AsyncTcpCallbackServer.run_client before the buffer based readers.
+    '''
+    data_as_str = ''
+    for start in range(0, len(message), chunk_size):
+        data_as_str += message[start:start+chunk_size].decode('utf-8').strip()
+        try:
+            return json.loads(data_as_str)
+        except ValueError:
+            continue
+
+
+def reader_receive(reader, message, chunk_size):
+    '''
+    Copies 'message' into the reader the way 'recv_into' would, at most 'chunk_size' bytes at a time.
+    '''
+    view = memoryview(message)
+    position = 0
+    while position < len(message):
+        writable = reader.writable()
+        size = min(len(writable), chunk_size, len(message) - position)
+        writable[:size] = view[position:position+size]
+        reader.commit(size)
+        position += size
+        for item in reader:
+            payload = item[1] if isinstance(item, tuple) else item
+            return json.loads(payload.decode('utf-8'))
+
+
+def measure(receive, repeat):
+    tracemalloc.start()
+    start = perf_counter()
+    for _ in range(repeat):
+        receive()
+    elapsed = (perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def receive_benchmark(size, chunk_size, repeat):
+    message = json.dumps({'code': base64.b64encode(urandom(size * 3 // 4)).decode('utf-8'), 'context': None}).encode('utf-8')
+    framed_message = frame(message)
+    megabytes = len(message) / (1 << 20)
+    candidates = (
+        ('original', lambda: original_receive(message, chunk_size)),
+        ('JsonReader', lambda: reader_receive(JsonReader(chunk_size), message, chunk_size)),
+        ('FrameReader', lambda: reader_receive(FrameReader(buffer_size=chunk_size), framed_message, chunk_size)),
+    )
+    print(f'message: {megabytes:.2f}MB received in chunks of {chunk_size} bytes')
+    for name, receive in candidates:
+        elapsed, peak = measure(receive, repeat)
+        print(f'{name:>12}: {elapsed * 1000 / megabytes:10.2f} ms/MB {peak / (1 << 20) / megabytes:8.2f} MB peak memory per MB')
+
+
+def codec_benchmark(size, repeat):
+    with open(__file__, 'rb') as source:
+        code = source.read()
+    code = (code * (size // len(code) + 1))[:size]
+    context = {'path': 'asynctcp/benchmark.py', 'private_modules': ['asynctcp', 'asynctcp.codec']}
+    binary = codec.Encoding(binary=True)
+    compressed = codec.Encoding(binary=True, compression=True, compression_threshold=0)
+    candidates = (
+        (
+            'JSON+base64',
+            lambda: json.dumps({'code': base64.b64encode(code).decode('utf-8'), 'context': context}).encode('utf-8'),
+            lambda payload: base64.b64decode(json.loads(payload.decode('utf-8'))['code']),
+        ),
+        (
+            'binary',
+            lambda: binary.pack(codec.dumps({'code': code, 'context': context}), binary=True),
+            lambda payload: codec.loads(binary.unpack(payload)[0])['code'],
+        ),
+        (
+            'binary+zlib',
+            lambda: compressed.pack(codec.dumps({'code': code, 'context': context}), binary=True),
+            lambda payload: codec.loads(compressed.unpack(payload)[0])['code'],
+        ),
+    )
+    print(f'request: {size} bytes of code')
+    for name, encode, decode in candidates:
+        payload = encode()
+        assert decode(payload) == code
+        start = perf_counter()
+        for _ in range(repeat):
+            encode()
+        encoding = (perf_counter() - start) / repeat
+        start = perf_counter()
+        for _ in range(repeat):
+            decode(payload)
+        decoding = (perf_counter() - start) / repeat
+        print(f'{name:>12}: {len(payload):10} bytes {encoding * 1000:8.3f} ms to encode {decoding * 1000:8.3f} ms to decode')
+
+
+async def echo(request):
+    return json.dumps(request)
+
+
+async def cpu(request):
+    sum(i * i for i in range(CPU_BOUND_ITERATIONS))
+    return json.dumps(request)
+
+
+async def sleep_handler(request):
+    await curio.sleep(SLEEP_DURATION)
+    return json.dumps(request)
+
+
+HANDLERS = {
+    'echo': echo,
+    'cpu': cpu,
+    'sleep': sleep_handler,
+}
+
+
+def percentile(sorted_values, fraction):
+    '''
+    Nearest-rank percentile of a sorted list, None if it is empty.
+    '''
+    if not sorted_values:
+        return
+    rank = max(int(round(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_server(handler, port, workers, memoized, shared_memory_threshold=None, acceptors=1):
+    '''
+    Target of the server process. The server is created here so each one gets its own channel path.
+    '''
+    if workers:
+        # workers import the handler by name
+        request_handler = f'{__package__}.benchmark.{HANDLERS[handler].__name__}'
+    else:
+        request_handler = HANDLERS[handler]
+    AsyncTcpCallbackServer(
+        '127.0.0.1',
+        port,
+        request_handler,
+        memoized = memoized,
+        parallel = bool(workers),
+        cpus = workers or None,
+        search_path = dirname(dirname(abspath(__file__))),
+        shared_memory_threshold = shared_memory_threshold,
+        acceptors = acceptors,
+    ).run()
+
+
+def wait_for_server(port):
+    deadline = perf_counter() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            sleep(.05)
+
+
+def run_connection(pipe, start, port, connection, payload_size, distinct, duration, framed):
+    '''
+    Target of a client process: sends requests over one connection for 'duration' seconds once 'start' is set,
+    then sends back the latency of every reply and the number of errors.
+    '''
+    client = BlockingTcpClient('127.0.0.1', port, framed=framed)
+    payload = 'x' * payload_size
+    latencies = []
+    errors = 0
+    pipe.send('ready')
+    start.wait()
+    deadline = perf_counter() + duration
+    number = 0
+    while perf_counter() < deadline:
+        request = json.dumps({'id': number % distinct if distinct else f'{connection}.{number}', 'payload': payload})
+        number += 1
+        sent = perf_counter()
+        try:
+            response = client.send(request)
+        except socket.timeout:
+            # the reply may still arrive, so this connection can't be used anymore
+            errors += 1
+            break
+        except ConnectionError:
+            errors += 1
+            break
+        if response is None:
+            errors += 1
+        else:
+            latencies.append(perf_counter() - sent)
+    client.close()
+    pipe.send((latencies, errors))
+
+
+def load_scenario(handler, connections, payload_size, workers, memoized, duration, port, distinct, framed, shared_memory_threshold=None, acceptors=1):
+    '''
+    Returns the results of one scenario of the load benchmark.
+    '''
+    server = Process(target=run_server, args=(handler, port, workers, memoized, shared_memory_threshold, acceptors), name='Benchmark server')
+    server.start()
+    clients = []
+    try:
+        wait_for_server(port)
+        start = Event()
+        for connection in range(connections):
+            pipe, client_pipe = Pipe()
+            process = Process(
+                target=run_connection,
+                args=(client_pipe, start, port, connection, payload_size, distinct, duration, framed),
+                name='Benchmark client '+str(connection),
+            )
+            process.start()
+            clients.append((process, pipe))
+        for _, pipe in clients:
+            pipe.recv()
+        start.set()
+        latencies = []
+        errors = 0
+        for _, pipe in clients:
+            client_latencies, client_errors = pipe.recv()
+            latencies += client_latencies
+            errors += client_errors
+    finally:
+        for process, _ in clients:
+            process.join()
+        server.terminate()
+        server.join()
+    latencies.sort()
+    return {
+        'handler': handler,
+        'connections': connections,
+        'payload': payload_size,
+        'workers': workers,
+        'memoized': memoized,
+        'framed': framed,
+        'shared_memory_threshold': shared_memory_threshold,
+        'acceptors': acceptors,
+        'duration': duration,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': len(latencies) / duration,
+        'latency_ms': {
+            name: value * 1000 if value is not None else None
+            for name, value in (
+                ('p50', percentile(latencies, .50)),
+                ('p95', percentile(latencies, .95)),
+                ('p99', percentile(latencies, .99)),
+                ('max', latencies[-1] if latencies else None),
+            )
+        },
+    }
+
+
+def load_benchmark(
+    handlers,
+    connections,
+    payloads,
+    workers,
+    memoized,
+    duration,
+    port=11311,
+    distinct=None,
+    framed=False,
+    shared_memory_threshold=None,
+    acceptors=1,
+    output=None,
+):
+    '''
+    Runs a scenario for every combination of the parameters, prints one line per scenario
+    and returns the results, also written to 'output' as JSON if set.
+    '''
+    results = []
+    print(f'{"handler":>8} {"conn":>5} {"payload":>8} {"workers":>7} {"memo":>5} {"req/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>6}')
+    for scenario in product(handlers, connections, payloads, workers, memoized):
+        result = load_scenario(*scenario, duration, port, distinct, framed, shared_memory_threshold, acceptors)
+        results.append(result)
+        latency = result['latency_ms']
+        print(
+            f'{result["handler"]:>8} {result["connections"]:>5} {result["payload"]:>8} {result["workers"]:>7} {str(result["memoized"]):>5}'
+            f' {result["requests_per_second"]:>10.1f} {latency["p50"] or 0:>8.2f} {latency["p95"] or 0:>8.2f} {latency["p99"] or 0:>8.2f} {result["errors"]:>6}'
+        )
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump({
+                'date': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': cpu_count(),
+                'results': results,
+            }, output_file, indent=2)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    receive = commands.add_parser('receive', help='receive path microbenchmark')
+    receive.add_argument('--size', type=int, default=1 << 22, help='size of the message in bytes')
+    receive.add_argument('--chunk', type=int, default=1 << 13, help='number of bytes received at once')
+    receive.add_argument('--repeat', type=int, default=3)
+    codec_parser = commands.add_parser('codec', help='request encoding microbenchmark')
+    codec_parser.add_argument('--size', type=int, default=1 << 16, help='size of the code in bytes')
+    codec_parser.add_argument('--repeat', type=int, default=100)
+    load = commands.add_parser('load', help='throughput and latency of a local server under load')
+    load.add_argument('--handler', nargs='+', choices=sorted(HANDLERS), default=['echo'], help='request handlers: echo, CPU-bound or sleeping')
+    load.add_argument('--connections', nargs='+', type=int, default=[1, 8], help='numbers of concurrent client connections')
+    load.add_argument('--payload', nargs='+', type=int, default=[100], help='sizes of the request payload in bytes')
+    load.add_argument('--workers', nargs='+', type=int, default=[0, cpu_count()], help='numbers of worker subprocesses, 0 for a non-parallel server')
+    load.add_argument('--memoized', nargs='+', choices=('off', 'on'), default=['off'])
+    load.add_argument('--distinct', type=int, default=None, help='number of distinct requests sent by each connection. Defaults to all distinct')
+    load.add_argument('--framed', action='store_true', help='use the framed protocol')
+    load.add_argument('--shared-memory-threshold', type=int, default=None, help='see AsyncTcpCallbackServer')
+    load.add_argument('--acceptors', type=int, default=1, help='number of acceptor processes, see AsyncTcpCallbackServer')
+    load.add_argument('--duration', type=float, default=5, help='seconds each scenario runs for')
+    load.add_argument('--port', type=int, default=11311)
+    load.add_argument('--output', help='file to write the results to, as JSON')
+    arguments = parser.parse_args()
+    if arguments.command == 'receive':
+        receive_benchmark(arguments.size, arguments.chunk, arguments.repeat)
+    elif arguments.command == 'codec':
+        codec_benchmark(arguments.size, arguments.repeat)
+    elif arguments.command == 'load':
+        load_benchmark(
+            arguments.handler,
+            arguments.connections,
+            arguments.payload,
+            arguments.workers,
+            [ value == 'on' for value in arguments.memoized ],
+            arguments.duration,
+            port = arguments.port,
+            distinct = arguments.distinct,
+            framed = arguments.framed,
+            shared_memory_threshold = arguments.shared_memory_threshold,
+            acceptors = arguments.acceptors,
+            output = arguments.output,
+        )
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import blake2b
+import logging
+import os
+import sqlite3
+from time import monotonic, time
+
+from curio import Event
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    '''
+    In-memory cache of encoded responses for the memoized AsyncTcpCallbackServer.
+    Bounded by both the number of entries and their total size in bytes,
+    evicting the least recently used entries first.
+    Entries older than 'ttl' seconds, if set, are treated as missing.
+    '''
+    def __init__(self, max_entries = 1 << 16, max_bytes = 1 << 28, ttl = None):
+        '''
+            max_entries:    maximum number of cached responses. Defaults to 65536.
+            max_bytes:      maximum total size of the cached keys and responses. Defaults to 256MB.
+            ttl:            time to live of an entry, in seconds. Defaults to None, meaning entries never expire.
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiration time, response), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @staticmethod
+    def sizeof(key, response):
+        return len(key) + len(response)
+
+    def get(self, key):
+        '''
+        Returns the cached response for 'key', or None.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return
+        expiration, response = entry
+        if expiration is not None and expiration <= monotonic():
+            self.discard(key)
+            self.expirations += 1
+            self.misses += 1
+            return
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        '''
+        Caches 'response' under 'key', evicting least recently used entries as needed.
+        Responses too large to ever fit are not cached.
+        '''
+        size = self.sizeof(key, response)
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = (monotonic() + self.ttl if self.ttl is not None else None, response)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            evicted_key, (_, evicted_response) = self.entries.popitem(last=False)
+            self.size -= self.sizeof(evicted_key, evicted_response)
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= self.sizeof(key, entry[1])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedResponseCache(object):
+    '''
+    Cache of encoded responses shared by all the server processes of a host, replicas or acceptors,
+    so a response computed by one of them is reused by the others.
+    Entries are stored in an SQLite database at 'path', in WAL mode so readers don't block the writer,
+    and memory-mapped so reading a cached response is mostly a copy from the page cache.
+    Like ResponseCache, it is bounded by both the number of entries and their total size in bytes,
+    evicting the least recently used entries first, and entries older than 'ttl' seconds are treated as missing.
+    The hit, miss, eviction and expiration counts are those of this process only.
+    A database error is logged and handled as a miss, so the server keeps working without its cache.
+
+    The database outlives the servers, so a server restarted with the same path starts with a warm cache.
+    Each write is a transaction, so a crash loses at most the last few writes, never the database.
+    Entries are tagged with the 'version' of the handler that computed them:
+    they are only returned to servers of the same version, and those of other versions are removed when the cache is opened.
+    '''
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path, max_entries = 1 << 16, max_bytes = 1 << 28, ttl = None, touch_interval = 1, timeout = .1, version = ''):
+        '''
+            path:           path of the database file, created if it doesn't exist.
+                            Every process opening the same path shares the same cache.
+            version:        version of the request handler, e.g. that of its package.
+                            Responses cached by another version are never returned. Defaults to ''.
+            max_entries:    maximum number of cached responses. Defaults to 65536.
+            max_bytes:      maximum total size of the cached keys and responses. Defaults to 256MB.
+            ttl:            time to live of an entry, in seconds. Defaults to None, meaning entries never expire.
+            touch_interval: the last use of an entry is only recorded if the previous one is older than this many seconds,
+                            so most hits are reads only. Defaults to 1.
+            timeout:        how long to wait for another process to finish writing, in seconds. Defaults to .1.
+        '''
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.timeout = timeout
+        self.version = str(version)
+        self.key_salt = blake2b(self.version.encode('utf-8'), digest_size=16).digest()
+        self.pid = None
+        self._connection = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        self.connection # fail early if the database can't be opened
+
+    @property
+    def connection(self):
+        '''
+        The connection of this process to the database. A forked process opens its own.
+        '''
+        if self.pid != os.getpid():
+            self._connection = self.connect()
+            self.pid = os.getpid()
+        return self._connection
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(f'PRAGMA mmap_size={int(self.max_bytes * 2)}')
+        with self.transaction(connection):
+            if connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                # created by another version of this class, the cached responses are dropped.
+                connection.execute('DROP TABLE IF EXISTS responses')
+                connection.execute('DROP TABLE IF EXISTS totals')
+                connection.execute(f'PRAGMA user_version={self.SCHEMA_VERSION}')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key BLOB PRIMARY KEY,
+                    response BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expiration REAL,
+                    last_used REAL NOT NULL,
+                    version TEXT NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            connection.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)')
+            connection.execute('INSERT OR IGNORE INTO totals VALUES (0, 0, 0)')
+            if self.pid is None:
+                # opened by the server rather than one of its forked acceptors
+                connection.execute('DELETE FROM responses WHERE version != ?', (self.version,))
+                self.recount(connection)
+        return connection
+
+    @staticmethod
+    def recount(connection):
+        connection.execute('UPDATE totals SET entries = (SELECT count(*) FROM responses), bytes = (SELECT total(size) FROM responses)')
+
+    @staticmethod
+    @contextmanager
+    def transaction(connection):
+        '''
+        A write transaction, started immediately so that it never has to wait for a lock halfway.
+        '''
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def encode_key(self, key):
+        '''
+        Keys are str or bytes, and the stored key is a fixed size hash of them and of the version.
+        '''
+        if isinstance(key, str):
+            key = b's' + key.encode('utf-8')
+        else:
+            key = b'b' + bytes(key)
+        return blake2b(key, digest_size=16, key=self.key_salt).digest()
+
+    @staticmethod
+    def sizeof(key, response):
+        return len(key) + len(response)
+
+    def __len__(self):
+        try:
+            return self.connection.execute('SELECT entries FROM totals').fetchone()[0]
+        except sqlite3.Error as error:
+            self.error(error)
+            return 0
+
+    def __contains__(self, key):
+        try:
+            return self.connection.execute('SELECT 1 FROM responses WHERE key = ?', (self.encode_key(key),)).fetchone() is not None
+        except sqlite3.Error as error:
+            self.error(error)
+            return False
+
+    def error(self, error):
+        self.errors += 1
+        LOGGER.warning(f'Shared response cache {self.path}: {error}')
+
+    def get(self, key):
+        '''
+        Returns the cached response for 'key', or None.
+        '''
+        stored_key = self.encode_key(key)
+        try:
+            connection = self.connection
+            row = connection.execute('SELECT response, expiration, last_used FROM responses WHERE key = ?', (stored_key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return
+            response, expiration, last_used = row
+            now = time()
+            if expiration is not None and expiration <= now:
+                with self.transaction(connection):
+                    self.delete(connection, stored_key)
+                self.expirations += 1
+                self.misses += 1
+                return
+            if now - last_used >= self.touch_interval:
+                connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, stored_key))
+        except sqlite3.Error as error:
+            self.error(error)
+            self.misses += 1
+            return
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        '''
+        Caches 'response' under 'key', evicting least recently used entries as needed.
+        Responses too large to ever fit are not cached.
+        '''
+        size = self.sizeof(key, response)
+        if size > self.max_bytes:
+            return
+        stored_key = self.encode_key(key)
+        now = time()
+        try:
+            connection = self.connection
+            with self.transaction(connection):
+                self.delete(connection, stored_key)
+                connection.execute(
+                    'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (stored_key, bytes(response), size, now + self.ttl if self.ttl is not None else None, now, self.version),
+                )
+                connection.execute('UPDATE totals SET entries = entries + 1, bytes = bytes + ?', (size,))
+                self.evict(connection)
+        except sqlite3.Error as error:
+            self.error(error)
+
+    def evict(self, connection, batch_size=64):
+        while True:
+            entries, size = connection.execute('SELECT entries, bytes FROM totals').fetchone()
+            if entries <= self.max_entries and size <= self.max_bytes:
+                return
+            oldest = connection.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT ?', (batch_size,)).fetchall()
+            if not oldest:
+                # the totals don't match the stored responses, e.g. they were deleted by a server of another version
+                self.recount(connection)
+                return
+            for stored_key, entry_size in oldest:
+                if entries <= self.max_entries and size <= self.max_bytes:
+                    break
+                self.delete(connection, stored_key)
+                entries -= 1
+                size -= entry_size
+                self.evictions += 1
+
+    @staticmethod
+    def delete(connection, stored_key):
+        row = connection.execute('SELECT size FROM responses WHERE key = ?', (stored_key,)).fetchone()
+        if row is not None:
+            connection.execute('DELETE FROM responses WHERE key = ?', (stored_key,))
+            connection.execute('UPDATE totals SET entries = entries - 1, bytes = bytes - ?', (row[0],))
+
+    def discard(self, key):
+        try:
+            connection = self.connection
+            with self.transaction(connection):
+                self.delete(connection, self.encode_key(key))
+        except sqlite3.Error as error:
+            self.error(error)
+
+    def clear(self):
+        try:
+            connection = self.connection
+            with self.transaction(connection):
+                connection.execute('DELETE FROM responses')
+                connection.execute('UPDATE totals SET entries = 0, bytes = 0')
+        except sqlite3.Error as error:
+            self.error(error)
+
+    def stats(self):
+        try:
+            entries, size = self.connection.execute('SELECT entries, bytes FROM totals').fetchone()
+        except sqlite3.Error as error:
+            self.error(error)
+            entries = size = None
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'errors': self.errors,
+            'path': self.path,
+            'version': self.version,
+        }
+
+
+class TieredCache(object):
+    '''
+    A small and fast cache in front of a larger or slower one, typically
+    a ResponseCache in front of a SharedResponseCache, so the most used responses are served from memory
+    while all of them are kept on disk and shared with the other servers.
+    Responses found in the back cache only are copied into the front one.
+    '''
+    def __init__(self, front, back):
+        self.front = front
+        self.back = back
+
+    def __len__(self):
+        return len(self.back)
+
+    def __contains__(self, key):
+        return key in self.front or key in self.back
+
+    def get(self, key):
+        response = self.front.get(key)
+        if response is None:
+            response = self.back.get(key)
+            if response is not None:
+                self.front.put(key, response)
+        return response
+
+    def put(self, key, response):
+        self.front.put(key, response)
+        self.back.put(key, response)
+
+    def discard(self, key):
+        self.front.discard(key)
+        self.back.discard(key)
+
+    def clear(self):
+        self.front.clear()
+        self.back.clear()
+
+    def stats(self):
+        return {
+            'front': self.front.stats(),
+            'back': self.back.stats(),
+        }
+
+
+class PendingResponse(object):
+    '''
+    A response being computed by a memoized server.
+    Identical requests received in the meantime wait for it instead of being computed again.
+    '''
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+
+    async def wait(self):
+        '''
+        Returns the response, or None if computing it failed.
+        '''
+        await self.done.wait()
+        return self.response
+
+    async def finish(self, response=None):
+        self.response = response
+        await self.done.set()
@@ -0,0 +1,76 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+
+# upper bounds of the latency buckets, in seconds: 10µs to about 84s, doubling each time.
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** exponent for exponent in range(24))
+
+
+class Histogram(object):
+    '''
+    Counts observed values in fixed buckets, so recording one is a binary search and an increment.
+    Percentiles are estimated as the upper bound of the bucket they fall in, capped by the largest observed value.
+    '''
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket holds values above the last bound
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(.50),
+            'p95': self.percentile(.95),
+            'p99': self.percentile(.99),
+            'max': self.max,
+        }
+
+
+class Metrics(object):
+    '''
+    Named counters and latency histograms of an AsyncTcpCallbackServer, created on first use.
+    Latencies are in seconds.
+    '''
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'latencies': { name: histogram.snapshot() for name, histogram in self.histograms.items() },
+        }
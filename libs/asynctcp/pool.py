@@ -0,0 +1,187 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import socket
+from threading import Condition
+from time import monotonic
+
+from .asynctcp import BlockingTcpClient
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BlockingTcpClientPool(object):
+    '''
+    Thread-safe pool of BlockingTcpClient connections to one server, with the interface of BlockingTcpClient,
+    so each thread sending a request gets a connection of its own and many requests can be handled in parallel.
+
+    Connections are opened when a request finds none idle, up to 'max_size', and closed once idle for 'idle_timeout' seconds.
+    A connection idle for more than 'health_check_interval' seconds is checked before being reused,
+    so connections the server closed, e.g. when it restarted, are replaced rather than failing the request.
+    A connection that fails or times out is discarded, and a request whose connection was closed under it is sent again once
+    on a new connection. A None reply, sent when the handler failed, is returned as is.
+    '''
+    def __init__(self, host = 'localhost', port = 25252, max_size = 8, idle_timeout = 60, health_check_interval = 1, wait_timeout = None, **kwargs):
+        '''
+            max_size:       maximum number of connections. Defaults to 8.
+            idle_timeout:   connections idle for longer than this many seconds are closed. Defaults to 60.
+            health_check_interval: connections idle for longer than this many seconds are checked before being used. Defaults to 1.
+            wait_timeout:   how long to wait for a connection when all 'max_size' are in use, in seconds.
+                            Defaults to None, meaning forever.
+            kwargs:         the other options of the connections, see BlockingTcpClient.
+        '''
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self.options = kwargs
+        self.idle = deque() # (client, time it was released), most recently released last
+        self.size = 0 # number of connections, idle or in use
+        self.released = Condition()
+        self.closed = False
+        self.created = 0
+        self.discarded = 0
+
+    def create(self):
+        return BlockingTcpClient(self.host, self.port, **self.options)
+
+    @staticmethod
+    def alive(client):
+        '''
+        Returns False if the server closed the connection, or sent data no request is waiting for.
+        '''
+        if client.multiplexed:
+            # the reader thread of the connection fails the pending requests if it is closed
+            return True
+        try:
+            client.socket.setblocking(False)
+            try:
+                return not client.socket.recv(1, socket.MSG_PEEK)
+            finally:
+                client.socket.settimeout(client.timeout)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def acquire(self):
+        '''
+        Returns an idle connection, or a new one if there is none and the pool isn't full.
+        '''
+        with self.released:
+            while True:
+                if self.closed:
+                    raise ValueError('Pool to {}:{} is closed'.format(self.host, self.port))
+                self.evict()
+                if self.idle:
+                    client, released_at = self.idle.pop()
+                    if monotonic() - released_at < self.health_check_interval or self.alive(client):
+                        return client
+                    self.discard(client)
+                    continue
+                if self.size < self.max_size:
+                    self.size += 1
+                    self.created += 1
+                    break
+                if not self.released.wait(self.wait_timeout):
+                    raise socket.timeout('No connection to {}:{} available'.format(self.host, self.port))
+        try:
+            client = self.create()
+        except:
+            with self.released:
+                self.size -= 1
+                self.released.notify()
+            raise
+        return client
+
+    def release(self, client, broken = False):
+        with self.released:
+            if broken or self.closed:
+                self.discard(client)
+            else:
+                self.idle.append((client, monotonic()))
+            self.released.notify()
+
+    def discard(self, client):
+        '''
+        Closes a connection of the pool. Must be called holding 'released'.
+        '''
+        client.close()
+        self.size -= 1
+        self.discarded += 1
+
+    def evict(self):
+        '''
+        Closes the connections idle for longer than 'idle_timeout'. Must be called holding 'released'.
+        '''
+        expired = monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][1] < expired:
+            self.discard(self.idle.popleft()[0])
+
+    @contextmanager
+    def connection(self):
+        '''
+        A connection of the pool for the duration of the 'with' block, discarded if the block fails.
+        '''
+        client = self.acquire()
+        try:
+            yield client
+        except:
+            self.release(client, broken = True)
+            raise
+        self.release(client)
+
+    def send(self, data):
+        for attempt in range(2):
+            client = self.acquire()
+            try:
+                response = client.send(data)
+            except ConnectionError as exc:
+                self.release(client, broken = True)
+                if attempt:
+                    raise
+                # most likely the server restarted since the connection was last used
+                LOGGER.warning('Connection to {}:{} lost, retrying: {!r}'.format(self.host, self.port, exc))
+                continue
+            except:
+                self.release(client, broken = True)
+                raise
+            self.release(client)
+            return response
+
+    def send_many(self, requests):
+        '''
+        Returns the replies to all 'requests', in the same order, sent on a single connection.
+        '''
+        with self.connection() as client:
+            return client.send_many(requests)
+
+    def stats(self):
+        '''
+        Returns the stats of the server, see AsyncTcpCallbackServer.stats.
+        '''
+        with self.connection() as client:
+            return client.stats()
+
+    def pool_stats(self):
+        with self.released:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'max_size': self.max_size,
+                'created': self.created,
+                'discarded': self.discarded,
+            }
+
+    def close(self):
+        '''
+        Closes the idle connections, and those in use as they are released.
+        '''
+        with self.released:
+            self.closed = True
+            while self.idle:
+                self.discard(self.idle.popleft()[0])
+            self.released.notify_all()
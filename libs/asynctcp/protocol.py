@@ -0,0 +1,226 @@
+'''
+Wire format of the framed asynctcp protocol.
+
+A framed connection starts with the client sending MAGIC followed by a 'hello' frame,
+a JSON object listing the options the client would like to use.
+The server answers with MAGIC and a 'hello' frame of its own, holding the options it accepted.
+After that, every message in both directions is a frame: a length header followed by the payload bytes.
+If the hello negotiated 'multiplexed', the header also carries a request ID chosen by the client.
+Many requests may then be in flight on the connection, and replies come back in any order, tagged with the ID of their request.
+If it negotiated 'binary' or 'compression', requests may be sent in a binary encoding carrying bytes as is,
+and payloads may be compressed, see asynctcp.codec.
+
+Connections that do not start with MAGIC keep using the original protocol,
+where the end of a message is detected by trying to decode the received data as JSON.
+MAGIC starts with a NUL byte, which can never start a JSON text, so both protocols can share a port.
+
+With either protocol, a JSON object holding the CONTROL_KEY is addressed to the server itself rather than the request handler,
+e.g. {"__asynctcp__": "stats"} returns the server's stats.
+'''
+import json
+import re
+import struct
+
+
+MAGIC = b'\x00ATCP'
+
+HEADER = struct.Struct('!I')
+
+MULTIPLEXED_HEADER = struct.Struct('!II') # request ID, length
+
+PROTOCOL_VERSION = 1
+
+CONTROL_KEY = '__asynctcp__'
+
+
+class FrameTooLarge(ValueError):
+    '''
+    Raised by a FrameReader when a frame announces a payload larger than its 'max_size'.
+    '''
+    def __init__(self, request_id, size, max_size):
+        super().__init__(f'Frame of {size} bytes exceeds the maximum of {max_size} bytes')
+        self.request_id = request_id
+        self.size = size
+        self.max_size = max_size
+
+
+def frame(payload, request_id=None):
+    if request_id is None:
+        return HEADER.pack(len(payload)) + payload
+    return MULTIPLEXED_HEADER.pack(request_id, len(payload)) + payload
+
+
+def hello_frame(options):
+    return MAGIC + frame(json.dumps(options).encode('utf-8'))
+
+
+class MessageReader(object):
+    '''
+    Base class of the readers splitting the data received on a connection into messages.
+    Data is received straight into the writable buffer returned by 'writable' (see socket.recv_into),
+    then 'commit' is called with the number of bytes received.
+    Iterating over the reader yields the messages completed so far.
+    '''
+    def __init__(self, buffer_size=1 << 13):
+        self.chunk = memoryview(bytearray(buffer_size))
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def writable(self):
+        return self.chunk
+
+    def commit(self, size):
+        self.buffer += self.chunk[:size]
+
+    def take(self, start, end):
+        '''
+        Removes the buffered bytes up to 'end' and returns those starting at 'start'.
+        '''
+        with memoryview(self.buffer) as view:
+            message = bytes(view[start:end])
+        del self.buffer[:end]
+        return message
+
+
+class FrameReader(MessageReader):
+    '''
+    Yields (request ID, payload) for every complete frame.
+    The request ID is None unless 'header' is MULTIPLEXED_HEADER. 'header' may be switched between frames,
+    as is the case right after the hello of a multiplexed connection.
+    Once the header of a frame that isn't fully buffered yet has been read,
+    the rest of its payload is received directly into a buffer of the announced size,
+    so a large message is copied exactly once, however many 'recv_into' calls it takes.
+    Since that buffer is allocated from the size announced by the peer, frames larger than 'max_size', if set,
+    raise FrameTooLarge instead.
+    '''
+    def __init__(self, header=HEADER, buffer_size=1 << 13, max_size=None):
+        super().__init__(buffer_size)
+        self.header = header
+        self.max_size = max_size
+        self.request_id = None
+        self.payload = None # payload of the frame being received, if it wasn't complete when its header was read
+        self.received = 0
+
+    def writable(self):
+        if self.payload is None:
+            return self.chunk
+        return memoryview(self.payload)[self.received:]
+
+    def commit(self, size):
+        if self.payload is None:
+            super().commit(size)
+        else:
+            self.received += size
+
+    def __iter__(self):
+        while True:
+            if self.payload is not None:
+                if self.received < len(self.payload):
+                    return
+                payload, self.payload = self.payload, None
+                yield self.request_id, payload
+                continue
+            if len(self.buffer) < self.header.size:
+                return
+            if self.header is MULTIPLEXED_HEADER:
+                self.request_id, size = self.header.unpack_from(self.buffer)
+            else:
+                self.request_id, (size,) = None, self.header.unpack_from(self.buffer)
+            if self.max_size is not None and size > self.max_size:
+                raise FrameTooLarge(self.request_id, size, self.max_size)
+            del self.buffer[:self.header.size]
+            if len(self.buffer) >= size:
+                yield self.request_id, self.take(0, size)
+            else:
+                self.payload = bytearray(size)
+                self.payload[:len(self.buffer)] = self.buffer
+                self.received = len(self.buffer)
+                del self.buffer[:]
+
+
+class JsonReader(MessageReader):
+    '''
+    Yields every complete JSON text received with the original, unframed protocol.
+    The end of an object, array or string is found by scanning each received byte once for quotes, escapes and brackets,
+    so the received data is neither decoded nor parsed until a message is complete.
+    Other top-level values (numbers, true, false, null) have no closing delimiter,
+    so for those the buffered data is decoded after each 'recv' like the original protocol did.
+    '''
+    STRUCTURE = re.compile(rb'["{}\[\]]')
+
+    def __init__(self, buffer_size=1 << 13):
+        super().__init__(buffer_size)
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.quote = -1 # position of the next quote, while in a string
+
+    def __iter__(self):
+        while True:
+            end = self.scan()
+            if end is None:
+                return
+            message = self.take(self.start, end)
+            self.reset()
+            yield message
+
+    def scan(self):
+        '''
+        Returns the end of the message being received, or None if it is incomplete.
+        '''
+        buffer = self.buffer
+        if self.start is None:
+            self.start = len(buffer) - len(buffer.lstrip())
+            if self.start == len(buffer):
+                self.start = None
+                return
+            self.position = self.start
+            if buffer[self.start] not in b'{["':
+                try:
+                    json.loads(buffer[self.start:].decode('utf-8'))
+                    return len(buffer)
+                except ValueError:
+                    self.start = None
+                    return
+        position = self.position
+        while True:
+            if self.in_string:
+                # strings make up most of the data, so they are scanned with 'find' rather than a regular expression.
+                if self.quote < position:
+                    self.quote = buffer.find(b'"', position)
+                escape = buffer.find(b'\\', position, self.quote if self.quote != -1 else len(buffer))
+                if escape != -1:
+                    if escape + 1 == len(buffer):
+                        # the escaped character hasn't been received yet
+                        self.position = escape
+                        return
+                    position = escape + 2
+                    continue
+                if self.quote == -1:
+                    self.position = len(buffer)
+                    return
+                position = self.quote + 1
+                self.in_string = False
+                if self.depth == 0:
+                    return position
+            else:
+                match = self.STRUCTURE.search(buffer, position)
+                if match is None:
+                    self.position = len(buffer)
+                    return
+                position = match.end()
+                character = buffer[match.start()]
+                if character == ord('"'):
+                    self.in_string = True
+                elif character in b'{[':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth <= 0:
+                        return position
@@ -0,0 +1,192 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+from threading import Lock
+from time import perf_counter
+
+from .metrics import Histogram
+from .pool import BlockingTcpClientPool
+
+
+LOGGER = logging.getLogger(__name__)
+
+LATENCY_SMOOTHING = .2 # weight of the latest latency in the moving average used to rank the replicas
+
+FAILURE_PENALTY = 5 # seconds a replica is ranked last for after a failed request
+
+
+class Replica(object):
+    '''
+    A server of a HedgedTcpClient, with the latencies of its replies.
+    '''
+    def __init__(self, host, port, window, **kwargs):
+        self.host = host
+        self.port = port
+        self.pool = BlockingTcpClientPool(host, port, **kwargs)
+        self.recent = deque(maxlen=window) # latencies of the latest replies, in seconds
+        self.histogram = Histogram()
+        self.average = None # moving average of the latency, None until the first reply
+        self.in_flight = 0
+        self.failed_at = None
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0 # requests sent as a hedge of a slow request to another replica
+        self.wins = 0 # hedges replied to before the request they duplicated
+
+    @property
+    def name(self):
+        return f'{self.host}:{self.port}'
+
+    def score(self):
+        '''
+        Replicas are ranked by the expected latency of a request sent now, after those that failed recently.
+        Replicas without any reply yet come first, so they get measured.
+        '''
+        failed = self.failed_at is not None and perf_counter() - self.failed_at < FAILURE_PENALTY
+        return (failed, (self.average or 0) * (1 + self.in_flight))
+
+    def percentile(self, fraction):
+        if not self.recent:
+            return
+        latencies = sorted(self.recent)
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'hedges': self.hedges,
+            'wins': self.wins,
+            'average': self.average,
+            'latency': self.histogram.snapshot(),
+        }
+
+
+class HedgedTcpClient(object):
+    '''
+    Client of several replicas of the same server, with the interface of BlockingTcpClient.
+    Each request is sent to the replica expected to reply the fastest, given the moving average of its latency
+    and the number of requests it is already handling for this client.
+    If the reply takes longer than the 'hedge_percentile' of that replica's recent latencies,
+    the request is also sent to the next best replica, and the first reply is returned,
+    so a replica stalled by a long request or a garbage collection doesn't stall its clients.
+    A request that fails, or is rejected as 'Overloaded', is sent to the next replica right away.
+    '''
+    def __init__(self, replicas, hedge_percentile = .95, hedge_delay = None, min_samples = 20, window = 200, max_size = 8, **kwargs):
+        '''
+            replicas:       list of (host, port) of the servers.
+            hedge_percentile: percentile of the latencies of a replica after which a request is sent to another one as well.
+                            Defaults to .95, so about 1 request in 20 is sent twice.
+            hedge_delay:    if set, the delay in seconds after which a request is sent to another replica, whatever its latencies.
+            min_samples:    requests are only hedged once the replica has replied to this many, unless 'hedge_delay' is set.
+                            Defaults to 20.
+            window:         number of recent latencies of each replica the percentile is computed over. Defaults to 200.
+            max_size:       maximum number of connections to each replica. Defaults to 8.
+            kwargs:         the other options of the connections, see BlockingTcpClientPool and BlockingTcpClient.
+        '''
+        if not replicas:
+            raise ValueError('At least one replica is required')
+        self.replicas = [ Replica(host, port, window, max_size = max_size, **kwargs) for host, port in replicas ]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.lock = Lock()
+        # every request may be in flight on 2 replicas
+        self.executor = ThreadPoolExecutor(max_workers = 2 * max_size * len(self.replicas), thread_name_prefix = 'HedgedTcpClient')
+        # threads waiting for the replies to 'send_many', which must not wait for the threads sending the requests
+        self.callers = ThreadPoolExecutor(max_workers = max_size * len(self.replicas), thread_name_prefix = 'HedgedTcpClient.send_many')
+
+    def ranked(self):
+        with self.lock:
+            return sorted(self.replicas, key = Replica.score)
+
+    def delay(self, replica):
+        '''
+        Seconds to wait for a reply of 'replica' before hedging the request, None to never hedge it.
+        '''
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self.lock:
+            if len(replica.recent) < self.min_samples:
+                return
+            return replica.percentile(self.hedge_percentile)
+
+    def send_to(self, replica, data):
+        with self.lock:
+            replica.in_flight += 1
+            replica.requests += 1
+        start = perf_counter()
+        try:
+            response = replica.pool.send(data)
+            if isinstance(response, dict) and response.get('error') == 'Overloaded':
+                raise ConnectionError(f'{replica.name} is overloaded')
+        except:
+            with self.lock:
+                replica.errors += 1
+                replica.failed_at = perf_counter()
+            raise
+        finally:
+            with self.lock:
+                replica.in_flight -= 1
+        latency = perf_counter() - start
+        with self.lock:
+            replica.recent.append(latency)
+            replica.histogram.observe(latency)
+            replica.average = latency if replica.average is None else replica.average + LATENCY_SMOOTHING * (latency - replica.average)
+        return response
+
+    def send(self, data):
+        candidates = self.ranked()
+        futures = {}
+        hedged = None
+        error = None
+        def submit(replica):
+            futures[self.executor.submit(self.send_to, replica, data)] = replica
+        submit(candidates.pop(0))
+        while futures:
+            timeout = None
+            if candidates and hedged is None:
+                timeout = self.delay(next(iter(futures.values())))
+            done, _ = wait(futures, timeout = timeout, return_when = FIRST_COMPLETED)
+            if not done:
+                # the reply is late, so hedge the request
+                hedged = candidates.pop(0)
+                with self.lock:
+                    hedged.hedges += 1
+                submit(hedged)
+                continue
+            for future in done:
+                replica = futures.pop(future)
+                try:
+                    response = future.result()
+                except Exception as exc:
+                    LOGGER.warning(f'Request to {replica.name} failed: {exc!r}')
+                    error = exc
+                    continue
+                if replica is hedged:
+                    with self.lock:
+                        replica.wins += 1
+                return response
+            if not futures and candidates:
+                submit(candidates.pop(0))
+        raise error
+
+    def send_many(self, requests):
+        '''
+        Returns the replies to all 'requests', in the same order, all of them being in flight at once.
+        '''
+        return list(self.callers.map(self.send, requests))
+
+    def replica_stats(self):
+        '''
+        Returns the latency and hedging stats of every replica, by 'host:port'.
+        '''
+        with self.lock:
+            return { replica.name: replica.stats() for replica in self.replicas }
+
+    def close(self):
+        self.callers.shutdown(wait = False)
+        self.executor.shutdown(wait = False)
+        for replica in self.replicas:
+            replica.pool.close()
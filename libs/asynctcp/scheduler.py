@@ -0,0 +1,78 @@
+from collections import deque
+from time import monotonic
+
+from curio import Semaphore
+
+
+class FairQueue(object):
+    '''
+    Queue of the requests waiting for a worker, shared fairly between flows.
+    A flow is a client connection, or a tenant if the request's envelope names one.
+
+    Each flow has its own FIFO queue. Flows with queued requests take turns in round-robin order,
+    and a flow takes up to its weight in requests per turn, so one flow sending a large batch of requests
+    only delays the requests of other flows by a turn, instead of by the whole batch.
+    Requests of a higher priority class are always served before those of lower ones.
+    '''
+    def __init__(self, weights=None, default_weight=1):
+        '''
+            weights:        dict of flow -> number of requests the flow may take per turn.
+            default_weight: weight of the flows not in 'weights'. Defaults to 1.
+        '''
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.flows = {} # (priority, flow) -> deque of (enqueue time, item)
+        self.rotations = {} # priority -> deque of the (priority, flow) keys with queued items, the flow being served first
+        self.served = {} # priority -> number of items the flow being served took in its current turn
+        self.length = 0
+        self.available = Semaphore(0)
+
+    def __len__(self):
+        return self.length
+
+    async def put(self, item, flow=None, priority=0):
+        key = (priority, flow)
+        queue = self.flows.get(key)
+        if queue is None:
+            queue = self.flows[key] = deque()
+            self.rotations.setdefault(priority, deque()).append(key)
+        queue.append((monotonic(), item))
+        self.length += 1
+        await self.available.release()
+
+    async def get(self):
+        '''
+        Waits for an item, and returns it along with the time it was queued.
+        '''
+        await self.available.acquire()
+        priority = max(self.rotations)
+        rotation = self.rotations[priority]
+        key = rotation[0]
+        queue = self.flows[key]
+        enqueued_at, item = queue.popleft()
+        self.length -= 1
+        served = self.served.get(priority, 0) + 1
+        if not queue:
+            del self.flows[key]
+            rotation.popleft()
+            if not rotation:
+                del self.rotations[priority]
+            served = 0
+        elif served >= self.weights.get(key[1], self.default_weight):
+            rotation.rotate(-1)
+            served = 0
+        self.served[priority] = served
+        return enqueued_at, item
+
+    def oldest(self):
+        '''
+        Returns the time the oldest queued item was queued, or None if the queue is empty.
+        '''
+        return min(( queue[0][0] for queue in self.flows.values() ), default=None)
+
+    def stats(self):
+        return {
+            'length': self.length,
+            'flows': len(self.flows),
+            'priorities': { priority: sum(len(self.flows[key]) for key in rotation) for priority, rotation in self.rotations.items() },
+        }
@@ -0,0 +1,150 @@
+'''
+Passing large payloads between an AsyncTcpCallbackServer and its worker subprocesses through shared memory.
+
+The sending process copies the payload into a shared memory segment of its SegmentPool,
+and only sends a SharedPayload, the name and size of the segment, over the channel.
+The receiving process reads the payload from the segment, attached once by name and kept attached,
+then tells the sender the segment can be reused.
+
+Segments are not tracked by the multiprocessing resource tracker, which would destroy them
+when any process that merely attached them exits. Instead, each process destroys the segments it created when it exits.
+'''
+from collections import defaultdict, OrderedDict
+import pickle
+import sys
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # Python < 3.8
+    SharedMemory = None
+
+TRACK_PARAMETER = sys.version_info >= (3, 13)
+
+
+def create_segment(size):
+    if TRACK_PARAMETER:
+        return SharedMemory(create=True, size=size, track=False)
+    segment = SharedMemory(create=True, size=size)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def attach_segment(name):
+    if TRACK_PARAMETER:
+        return SharedMemory(name, track=False)
+    segment = SharedMemory(name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def destroy_segment(segment):
+    segment.close()
+    if not TRACK_PARAMETER:
+        # 'unlink' unregisters the segment from the resource tracker
+        resource_tracker.register(segment._name, 'shared_memory')
+    segment.unlink()
+
+
+class SharedPayload(object):
+    '''
+    Handle of a payload held in a shared memory segment, sent over the channel instead of the payload.
+    '''
+    __slots__ = ('name', 'size')
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __getstate__(self):
+        return (self.name, self.size)
+
+    def __setstate__(self, state):
+        self.name, self.size = state
+
+
+class SegmentPool(object):
+    '''
+    The shared memory segments created by a process to send payloads.
+    Segment sizes are powers of 2, and released segments are kept for reuse,
+    up to 'max_free' of each size, so creating and mapping a segment is rare once the sizes in use are warmed up.
+    '''
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self.free = defaultdict(list) # segment size -> released segments
+        self.used = {} # name -> segment holding a payload not released yet
+
+    def put(self, data):
+        '''
+        Copies 'data' into a segment and returns its handle.
+        '''
+        size = len(data)
+        capacity = 1 << max(size - 1, 0).bit_length()
+        free = self.free[capacity]
+        segment = free.pop() if free else create_segment(capacity)
+        segment.buf[:size] = data
+        self.used[segment.name] = segment
+        return SharedPayload(segment.name, size)
+
+    def release(self, name):
+        segment = self.used.pop(name, None)
+        if segment is None:
+            return
+        free = self.free[segment.size]
+        if len(free) < self.max_free:
+            free.append(segment)
+        else:
+            destroy_segment(segment)
+
+    def close(self):
+        '''
+        Destroys all the segments, released or not.
+        '''
+        segments = list(self.used.values())
+        for free in self.free.values():
+            segments += free
+        for segment in segments:
+            destroy_segment(segment)
+        self.used.clear()
+        self.free.clear()
+
+
+class Attachments(object):
+    '''
+    The shared memory segments of another process this process reads payloads from, attached on first use.
+    At most 'max_attached' segments stay attached, the least recently used being detached first,
+    so segments the other process destroyed don't stay mapped here.
+    '''
+    def __init__(self, max_attached=16):
+        self.max_attached = max_attached
+        self.segments = OrderedDict()
+
+    def attach(self, name):
+        segment = self.segments.get(name)
+        if segment is None:
+            segment = self.segments[name] = attach_segment(name)
+            if len(self.segments) > self.max_attached:
+                self.segments.popitem(last=False)[1].close()
+        else:
+            self.segments.move_to_end(name)
+        return segment
+
+    def read(self, payload):
+        '''
+        Returns a copy of the payload as bytes.
+        '''
+        with self.attach(payload.name).buf[:payload.size] as view:
+            return bytes(view)
+
+    def load(self, payload):
+        '''
+        Returns the object pickled in the payload.
+        '''
+        with self.attach(payload.name).buf[:payload.size] as view:
+            return pickle.loads(view)
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
@@ -3,13 +3,25 @@ from logging import getLogger, Formatter, StreamHandler
 from time import sleep, perf_counter
 import json
 from multiprocessing import Process, Pipe, current_process
-from os.path import exists
+import os
+from os.path import exists, join
+import signal
 import socket
+import sqlite3
 from sys import stdout
+from tempfile import TemporaryDirectory
+from threading import Thread
 from unittest import TestCase
 
+import curio
 
-from . import AsyncTcpCallbackServer, BlockingTcpClient
+
+from . import AsyncTcpCallbackServer, AsyncTcpClient, BlockingTcpClient, BlockingTcpClientPool, HedgedTcpClient, CONTROL_KEY, ResponseCache, SharedResponseCache, TieredCache
+from . import codec, protocol
+from .benchmark import load_scenario, percentile
+from .metrics import Histogram
+from .scheduler import FairQueue
+from .sharedmemory import Attachments, SegmentPool
 
 
 LOGGER = getLogger(__name__)
@@ -60,12 +72,13 @@ def log_to_stdout():
 
 
 @contextmanager
-def server(request_handler, address='127.0.0.1', port=11111, parallel=True, cpus=None, worker_timeout=1):
+def server(request_handler, address='127.0.0.1', port=11111, parallel=True, cpus=None, worker_timeout=1, memoized=False, **kwargs):
     async_server = AsyncTcpCallbackServer(
         address,
         port,
         request_handler,
-        memoized=False,
+        memoized=memoized,
+        **kwargs,
         parallel=parallel,
         cpus=cpus,
         worker_subprocess_timeout=worker_timeout,
@@ -83,8 +96,8 @@ def server(request_handler, address='127.0.0.1', port=11111, parallel=True, cpus
 
 
 @contextmanager
-def Client(host='127.0.0.1', port=11111):
-        sync_client = BlockingTcpClient(host, port)
+def Client(host='127.0.0.1', port=11111, **kwargs):
+        sync_client = BlockingTcpClient(host, port, **kwargs)
         yield sync_client
         sync_client.close()
 
@@ -252,6 +265,1062 @@ class Parallel(TestCase):
         # that's 900 requests per second using 2 cores on a MacBook Early 2015
         self.many_clients(Parallel.echo, 2, 2, 450, None)
 
-            
 
+class Framed(TestCase):
+
+    async def echo(request):
+        return json.dumps(request)
+
+    def test_echo(self):
+        data = {'foo': 'bar'}
+        with server(Framed.echo, parallel=False):
+            with Client(framed=True) as client:
+                self.assertTrue(client.framed)
+                self.assertEqual(client.send(json.dumps(data)), data)
+                self.assertEqual(client.send(json.dumps(data)), data)
+
+    def test_message_much_larger_than_buffer_size(self):
+        data = {'code': 'x' * (1 << 22)}
+        with server(Framed.echo, parallel=False):
+            with Client(framed=True) as client:
+                self.assertEqual(client.send(json.dumps(data)), data)
+
+    def test_max_frame_size(self):
+        data = {'foo': 'bar'}
+        with server(Framed.echo, parallel=False, max_frame_size=1000):
+            with Client(framed=True) as client:
+                self.assertEqual(client.send(json.dumps(data)), data)
+                self.assertEqual(client.send(json.dumps({'code': 'x' * 2000}))['error'], 'InvalidRequest')
+                with self.assertRaises(ConnectionError):
+                    client.send(json.dumps(data))
+
+    def test_max_frame_size_multiplexed(self):
+        with server(Framed.echo, parallel=False, max_frame_size=1000):
+            with Client(multiplexed=True) as client:
+                self.assertEqual(client.send(json.dumps({'code': 'x' * 2000}))['error'], 'InvalidRequest')
+
+    def test_invalid_hello(self):
+        with server(Framed.echo, parallel=False):
+            for hello in (b'{"framing": 1', b'[1]', b'\xff', b'{"compression": 1}'):
+                with socket.create_connection(('127.0.0.1', 11111)) as client_socket:
+                    client_socket.sendall(protocol.MAGIC + protocol.frame(hello))
+                    data = b''
+                    while True:
+                        chunk = client_socket.recv(1 << 13)
+                        if not chunk:
+                            break
+                        data += chunk
+                self.assertTrue(data.startswith(protocol.MAGIC))
+                reply = json.loads(data[len(protocol.MAGIC) + protocol.HEADER.size:].decode('utf-8'))
+                self.assertEqual(reply['error'], 'InvalidRequest')
+
+    def test_json_client_on_same_server(self):
+        data = {'foo': 'bar'}
+        with server(Framed.echo, parallel=False):
+            with Client(framed=True) as framed_client, Client() as json_client:
+                self.assertEqual(framed_client.send(json.dumps(data)), data)
+                self.assertEqual(json_client.send(json.dumps(data)), data)
+
+
+class Multiplexed(TestCase):
+
+    async def delayed_echo(request):
+        await curio.sleep(request['delay'])
+        return json.dumps(request)
+
+    def test_replies_matched_out_of_order(self):
+        requests = [ {'delay': delay, 'id': index} for index, delay in enumerate((.5, 0, .25, 0)) ]
+        with server(Multiplexed.delayed_echo, parallel=False):
+            with Client(multiplexed=True, timeout=2) as client:
+                self.assertTrue(client.multiplexed)
+                start = perf_counter()
+                responses = client.send_many([ json.dumps(request) for request in requests ])
+                elapsed = perf_counter() - start
+        self.assertEqual(responses, requests)
+        self.assertLess(elapsed, .7)
+
+    async def failing_echo(request):
+        if request.get('fail'):
+            raise Exception('boom')
+        return json.dumps(request)
+
+    def test_failing_handler(self):
+        with server(Multiplexed.failing_echo, parallel=False):
+            with Client(multiplexed=True, timeout=2) as client:
+                failed, succeeded = client.send_many([ json.dumps({'fail': True}), json.dumps({'id': 1}) ])
+        self.assertEqual(failed['error'], 'InternalError')
+        self.assertEqual(succeeded, {'id': 1})
+
+    def test_futures(self):
+        with server(Multiplexed.delayed_echo, parallel=False):
+            with Client(multiplexed=True) as client:
+                slow = client.submit(json.dumps({'delay': .25}))
+                fast = client.submit(json.dumps({'delay': 0}))
+                self.assertEqual(fast.result(1), {'delay': 0})
+                self.assertFalse(slow.done())
+                self.assertEqual(slow.result(1), {'delay': .25})
+                self.assertEqual(client.send(json.dumps({'delay': 0})), {'delay': 0})
+
+
+class Cache(TestCase):
+
+    def test_lru_eviction_by_entries(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('a', b'1')
+        cache.put('b', b'2')
+        cache.get('a')
+        cache.put('c', b'3')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_by_bytes(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.put('c', b'1234')
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.size, 10)
+        cache.put('d', b'x' * 20)
+        self.assertNotIn('d', cache)
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=.1)
+        cache.put('a', b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        sleep(.15)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 1, 'hit_rate': .5, 'evictions': 0, 'expirations': 1})
+
+
+class SharedCache(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = join(self.directory.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lru_eviction_by_entries(self):
+        cache = SharedResponseCache(self.path, max_entries=2, touch_interval=0)
+        cache.put('a', b'1')
+        sleep(.01)
+        cache.put('b', b'2')
+        sleep(.01)
+        cache.get('a')
+        cache.put('c', b'3')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_by_bytes(self):
+        cache = SharedResponseCache(self.path, max_bytes=10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.put('c', b'1234')
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+        cache.put(b'd', b'x' * 20)
+        self.assertNotIn(b'd', cache)
+
+    def test_ttl(self):
+        cache = SharedResponseCache(self.path, ttl=.1)
+        cache.put('a', b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        sleep(.15)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_str_and_bytes_keys_are_distinct(self):
+        cache = SharedResponseCache(self.path)
+        cache.put('a', b'1')
+        cache.put(b'a', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get(b'a'), b'2')
+
+    def test_shared_between_processes(self):
+        cache = SharedResponseCache(self.path)
+        writer = Process(target=lambda: SharedResponseCache(self.path).put('numpy', b'{"numpy": 1}'))
+        writer.start()
+        writer.join()
+        self.assertEqual(cache.get('numpy'), b'{"numpy": 1}')
+        def forked():
+            # the cache was created before the fork, so the child opens its own connection
+            cache.put('react', b'{"react": 1}')
+        writer = Process(target=forked)
+        writer.start()
+        writer.join()
+        self.assertEqual(cache.get('react'), b'{"react": 1}')
+
+    def test_unusable_database_is_a_miss(self):
+        cache = SharedResponseCache(self.path)
+        cache.connection.execute('DROP TABLE responses')
+        cache.put('a', b'1')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_warm_after_restart(self):
+        SharedResponseCache(self.path, version='1.0').put('numpy', b'1')
+        self.assertEqual(SharedResponseCache(self.path, version='1.0').get('numpy'), b'1')
+
+    def test_new_version_invalidates_entries(self):
+        SharedResponseCache(self.path, version='1.0').put('numpy', b'1')
+        cache = SharedResponseCache(self.path, version='1.1')
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('numpy'))
+        cache.put('numpy', b'2')
+        self.assertEqual(SharedResponseCache(self.path, version='1.1').get('numpy'), b'2')
+
+    def test_totals_out_of_sync(self):
+        cache = SharedResponseCache(self.path, max_entries=2)
+        cache.put('numpy', b'1')
+        connection = sqlite3.connect(self.path)
+        connection.execute('UPDATE totals SET entries = 100')
+        connection.commit()
+        connection.close()
+        # eviction runs out of responses to evict before the totals are within bounds, then recounts them
+        cache.put('scipy', b'2')
+        self.assertEqual(len(cache), 0)
+        cache.put('scipy', b'2')
+        self.assertEqual(cache.get('scipy'), b'2')
+        self.assertEqual(len(cache), 1)
+
+    def test_older_schema_is_dropped(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE responses (key BLOB PRIMARY KEY, response BLOB NOT NULL)')
+        connection.commit()
+        connection.close()
+        cache = SharedResponseCache(self.path)
+        cache.put('numpy', b'1')
+        self.assertEqual(cache.get('numpy'), b'1')
+
+    def test_killed_writer(self):
+        def write():
+            cache = SharedResponseCache(self.path)
+            for number in range(1 << 20):
+                cache.put(str(number), b'x' * 1000)
+        writer = Process(target=write)
+        writer.start()
+        sleep(.5)
+        os.kill(writer.pid, signal.SIGKILL)
+        writer.join()
+        cache = SharedResponseCache(self.path)
+        self.assertEqual(cache.connection.execute('PRAGMA integrity_check').fetchone(), ('ok',))
+        entries = cache.connection.execute('SELECT count(*) FROM responses').fetchone()[0]
+        self.assertGreater(entries, 0)
+        self.assertEqual(len(cache), entries)
+        self.assertEqual(cache.get('0'), b'x' * 1000)
+
+    def test_tiered(self):
+        back = SharedResponseCache(self.path)
+        back.put('numpy', b'1')
+        cache = TieredCache(ResponseCache(), back)
+        self.assertEqual(cache.get('numpy'), b'1')
+        self.assertEqual(cache.get('numpy'), b'1')
+        self.assertEqual(cache.stats()['front']['hits'], 1)
+        self.assertEqual(cache.stats()['back']['hits'], 1)
+        cache.put('react', b'2')
+        self.assertEqual(back.get('react'), b'2')
+
+    async def pid_handler(request):
+        return json.dumps({'request': request, 'pid': os.getpid()})
+
+    def test_shared_by_acceptors(self):
+        request = json.dumps({'module': 'numpy'})
+        cache = SharedResponseCache(self.path)
+        with server(SharedCache.pid_handler, parallel=False, memoized=True, cache=cache, acceptors=2):
+            responses = []
+            acceptors = set()
+            for _ in range(20):
+                with Client() as client:
+                    responses.append(client.send(request))
+                    acceptors.add(client.stats()['acceptor'])
+        self.assertEqual(acceptors, {0, 1})
+        # the response computed by the first acceptor is returned by both
+        self.assertEqual(len({ response['pid'] for response in responses }), 1)
+
+
+class SingleFlight(TestCase):
+    calls = 0
+
+    async def counting_echo(request):
+        SingleFlight.calls += 1
+        await curio.sleep(.25)
+        return json.dumps(SingleFlight.calls)
+
+    def test_concurrent_identical_requests_computed_once(self):
+        with server(SingleFlight.counting_echo, parallel=False, memoized=True):
+            with Client(multiplexed=True) as client:
+                responses = client.send_many([ json.dumps({'module': 'numpy'}) ] * 10)
+                other = client.send(json.dumps({'module': 'react'}))
+        self.assertEqual(responses, [1] * 10)
+        self.assertEqual(other, 2)
+
+
+class RawCacheKeys(TestCase):
+    calls = 0
+
+    async def counting_handler(request):
+        RawCacheKeys.calls += 1
+        return json.dumps({'request': request, 'calls': RawCacheKeys.calls})
+
+    def test_cached_response_for_identical_messages(self):
+        request = json.dumps({'code': 'aW1wb3J0IG9z'})
+        with server(RawCacheKeys.counting_handler, parallel=False, memoized=True, raw_cache_keys=True):
+            with Client(framed=True) as framed_client, Client() as json_client:
+                first = framed_client.send(request)
+                self.assertEqual(framed_client.send(request + '\n'), first)
+                self.assertEqual(json_client.send(request), first)
+                self.assertEqual(framed_client.send(json.dumps({'code': ''}))['calls'], 2)
+        self.assertEqual(first, {'request': {'code': 'aW1wb3J0IG9z'}, 'calls': 1})
+
+    def test_invalid_json(self):
+        with server(RawCacheKeys.counting_handler, parallel=False, memoized=True, raw_cache_keys=True):
+            with Client(framed=True) as client:
+                self.assertEqual(client.send('{"foo":"ba}')['error'], 'InvalidRequest')
+
+
+class FakeSubprocess(object):
+    '''
+    Stands for both the connection to a worker subprocess and its task, echoing requests after 'delay' seconds.
+    '''
+    def __init__(self, delay=.1):
+        self.delay = delay
+        self.requests = curio.Queue()
+
+    async def send(self, message):
+        await self.requests.put(message)
+
+    async def recv(self):
+        tag, request = await self.requests.get()
+        await curio.sleep(self.delay)
+        return tag, json.dumps(request), self.delay
+
+    async def close(self):
+        pass
+
+    async def cancel(self):
+        pass
+
+
+class FakeSubprocessServer(AsyncTcpCallbackServer):
+
+    async def subprocess_launcher(self):
+        while True:
+            worker_id, response = await self.subprocess_launch_request.get()
+            subprocess = FakeSubprocess()
+            await response.put((subprocess, subprocess))
+
+    async def start(self):
+        tasks = [ await curio.spawn(self.subprocess_launcher()), await curio.spawn(self.autoscaler()) ]
+        for id in range(self.max_workers):
+            tasks.append( await curio.spawn(self.worker(id, self.worker_subprocess_timeout)) )
+        return tasks
+
+    async def scenario(self, requests, idle_time):
+        tasks = await self.start()
+        await curio.sleep(.05)
+        started = self.stats()['workers']
+        dispatched = [ await curio.spawn(self.dispatch(request, curio.Queue(maxsize=1))) for request in requests ]
+        responses = [ await task.join() for task in dispatched ]
+        busy = self.stats()['workers']
+        await curio.sleep(idle_time)
+        idle = self.stats()['workers']
+        for task in tasks:
+            await task.cancel()
+        return responses, started, busy, idle
+
+
+class ElasticPool(TestCase):
+
+    def evaluate(self, requests, idle_time=.5, **kwargs):
+        server = FakeSubprocessServer('127.0.0.1', 11111, 'echo', memoized=False, worker_subprocess_timeout=.2, **kwargs)
+        return curio.run(server.scenario(requests, idle_time))
+
+    def test_scale_up_and_down(self):
+        requests = [ {'id': index} for index in range(8) ]
+        responses, started, busy, idle = self.evaluate(requests, max_workers=4, min_workers=1)
+        self.assertEqual(responses, [ json.dumps(request).encode() for request in requests ])
+        self.assertEqual(started['running'], 0)
+        self.assertEqual(busy['spawned'], 4)
+        self.assertEqual(idle['running'], 1)
+        self.assertEqual(idle['retired'], 3)
+
+    def test_warm_up(self):
+        _, started, _, idle = self.evaluate([ {} ], max_workers=4, min_workers=2, warm_up=True)
+        self.assertEqual(started['running'], 2)
+        self.assertEqual(idle['running'], 2)
+        self.assertEqual(idle['spawned'], 2)
+
+    def test_scale_up_wait(self):
+        # one warm worker serves all 3 requests in .3s, so no request waits for a full second.
+        _, _, busy, _ = self.evaluate([ {} ] * 3, idle_time=0, max_workers=4, min_workers=1, warm_up=True, scale_up_wait=1)
+        self.assertEqual(busy['spawned'], 1)
+
+    def test_autoscaler_does_not_poll(self):
+        # the only worker is busy for 1s with nothing to scale, then the server is idle.
+        server = FakeSubprocessServer('127.0.0.1', 11111, 'echo', memoized=False, max_workers=1, min_workers=1, warm_up=True)
+        oldest = server.requests.oldest
+        checks = []
+        def counted_oldest():
+            checks.append(None)
+            return oldest()
+        server.requests.oldest = counted_oldest
+        responses, _, _, _ = curio.run(server.scenario([ {} ] * 10, .5))
+        self.assertEqual(len(responses), 10)
+        self.assertLess(len(checks), 30)
+
+
+class Preload(TestCase):
+
+    def test_workers_forked_from_template(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, cpus=2, preload=True):
+            with Client() as client:
+                responses = [ client.send(json.dumps(data)) for _ in range(3) ]
+        self.assertEqual(responses, [data] * 3)
+
+    def test_idle_workers_forked_again(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, cpus=1, worker_timeout=.5, preload=True):
+            with Client() as client:
+                self.assertEqual(client.send(json.dumps(data)), data)
+                sleep(1)
+                self.assertEqual(client.send(json.dumps(data)), data)
+
+
+class WorkerConcurrency(TestCase):
+
+    async def sleepy_echo(request):
+        await curio.sleep(.5)
+        return json.dumps(request)
+
+    def evaluate(self, worker_concurrency):
+        requests = [ {'id': index} for index in range(4) ]
+        with server(WorkerConcurrency.sleepy_echo, cpus=1, worker_concurrency=worker_concurrency, min_workers=1, warm_up=True):
+            with Client(multiplexed=True) as client:
+                start = perf_counter()
+                responses = client.send_many([ json.dumps(request) for request in requests ])
+                elapsed = perf_counter() - start
+        self.assertEqual(responses, requests)
+        return elapsed
+
+    def test_one_request_at_a_time(self):
+        self.assertGreater(self.evaluate(1), 2)
+
+    def test_overlapping_requests(self):
+        self.assertLess(self.evaluate(4), 1)
+
+
+class Benchmark(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, .5), 50)
+        self.assertEqual(percentile(values, .99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertEqual(percentile([ 7 ], .95), 7)
+        self.assertIsNone(percentile([], .5))
+
+    def test_load_scenario(self):
+        result = load_scenario('echo', 2, 100, 1, False, .5, 11311, None, False)
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['requests'], 0)
+        self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'])
+        json.dumps(result)
+
+
+class Stats(TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [ .001 ] * 90 + [ .1 ] * 10:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertAlmostEqual(snapshot['mean'], .0109)
+        self.assertLess(snapshot['p50'], .0025)
+        self.assertGreaterEqual(snapshot['p50'], .001)
+        self.assertEqual(snapshot['p99'], .1)
+        self.assertEqual(snapshot['max'], .1)
+        self.assertIsNone(Histogram().percentile(.5))
+
+    def test_control_message(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, parallel=False, memoized=True):
+            with Client() as client:
+                client.send(json.dumps(data))
+                client.send(json.dumps(data))
+                stats = client.stats()
+        self.assertEqual(stats['cache']['hits'], 1)
+        self.assertEqual(stats['cache']['hit_rate'], .5)
+        self.assertEqual(stats['open_connections'], 1)
+        self.assertEqual(stats['metrics']['counters']['requests'], 3)
+        self.assertEqual(stats['metrics']['counters']['control_messages'], 1)
+        self.assertEqual(stats['metrics']['latencies']['handler']['count'], 1)
+
+    def test_workers(self):
+        with server(Parallel.echo, cpus=1):
+            with Client(framed=True) as client:
+                client.send(json.dumps({}))
+                stats = client.stats()
+        latencies = stats['metrics']['latencies']
+        for name in ('queue_wait', 'worker_round_trip', 'handler', 'worker_cold_start'):
+            self.assertEqual(latencies[name]['count'], 1)
+        self.assertEqual(stats['workers']['spawned'], 1)
+
+    def test_stats_port(self):
+        with server(Parallel.echo, parallel=False, stats_port=11112):
+            with Client() as client:
+                client.send(json.dumps({}))
+            with socket.create_connection(('127.0.0.1', 11112)) as stats_socket:
+                data = b''
+                while True:
+                    chunk = stats_socket.recv(1 << 13)
+                    if not chunk:
+                        break
+                    data += chunk
+        stats = json.loads(data.decode('utf-8'))
+        self.assertEqual(stats['metrics']['counters']['requests'], 1)
+
+
+class AdmissionControl(TestCase):
+
+    def handle(self, batches, **kwargs):
+        '''
+        Sends each batch of requests at once to a server with one fake worker subprocess,
+        waiting for all the replies to a batch before sending the next one.
+        '''
+        server = FakeSubprocessServer('127.0.0.1', 11111, 'echo', memoized=False, max_workers=1, **kwargs)
+        async def scenario():
+            tasks = await server.start()
+            replies = []
+            for batch in batches:
+                handled = [ await curio.spawn(server.handle_message(json.dumps(request).encode(), curio.Queue(maxsize=1))) for request in batch ]
+                replies.append([ json.loads(await task.join()) for task in handled ])
+            for task in tasks:
+                await task.cancel()
+            return replies
+        return curio.run(scenario()), server.metrics.counters
+
+    def envelope(self, request, timeout):
+        return {CONTROL_KEY: {'timeout': timeout}, 'request': request}
+
+    def test_bounded_queue(self):
+        (replies,), counters = self.handle([ [ {'id': index} for index in range(5) ] ], max_queued_requests=2)
+        self.assertEqual(replies[:2], [ {'id': 0}, {'id': 1} ])
+        self.assertEqual([ reply['error'] for reply in replies[2:] ], [ 'Overloaded' ] * 3)
+        self.assertEqual(counters['rejected_requests'], 3)
+
+    def test_expired_requests_dropped(self):
+        # the fake subprocess takes .1s per request, so the 2nd and 3rd requests expire while queued
+        (replies,), counters = self.handle([ [ self.envelope({'id': index}, .05) for index in range(3) ] ])
+        self.assertEqual(replies[0], {'id': 0})
+        self.assertEqual([ reply['error'] for reply in replies[1:] ], [ 'Overloaded' ] * 2)
+        self.assertEqual(counters['expired_requests'], 2)
+
+    def test_rejected_when_expected_wait_exceeds_deadline(self):
+        first, second = self.handle([ [ {'id': 0} ], [ self.envelope({'id': 1}, .05), self.envelope({'id': 2}, 1) ] ])[0]
+        self.assertEqual(first, [ {'id': 0} ])
+        self.assertEqual(second[0]['error'], 'Overloaded')
+        self.assertEqual(second[1], {'id': 2})
+
+    def test_invalid_options(self):
+        invalid = [ {'timeout': 'soon'}, {'timeout': [1]}, {'priority': 'high'}, {'priority': 1.5}, {'tenant': ['acme']} ]
+        (replies,), counters = self.handle([ [ {CONTROL_KEY: options, 'request': {'id': 0}} for options in invalid ] ])
+        self.assertEqual([ reply['error'] for reply in replies ], [ 'InvalidRequest' ] * len(invalid))
+        self.assertEqual(counters['invalid_requests'], len(invalid))
+
+    def test_max_connections(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, parallel=False, max_connections=1):
+            first_client = BlockingTcpClient('127.0.0.1', 11111)
+            with Client(timeout=.5) as second_client:
+                self.assertEqual(first_client.send(json.dumps(data)), data)
+                with self.assertRaises(socket.timeout):
+                    second_client.send(json.dumps(data))
+                first_client.close()
+                # the second connection is accepted once the first one is closed
+                self.assertEqual(second_client.read(), data)
+
+    def test_client_deadline(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, cpus=1, memoized=True):
+            with Client(deadline=True) as client:
+                self.assertEqual(client.send(json.dumps(data)), data)
+                self.assertEqual(client.send(json.dumps(data)), data)
+                stats = client.stats()
+        self.assertEqual(stats['cache']['hits'], 1)
+
+
+class FairScheduling(TestCase):
+
+    def drain(self, queue, items):
+        async def scenario():
+            for item, flow, priority in items:
+                await queue.put(item, flow, priority)
+            return [ (await queue.get())[1] for _ in items ]
+        return curio.run(scenario())
+
+    def test_round_robin(self):
+        items = [ ('a%d' % index, 'a', 0) for index in range(4) ] + [ ('b0', 'b', 0), ('b1', 'b', 0) ]
+        self.assertEqual(self.drain(FairQueue(), items), ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_weights(self):
+        items = [ ('a%d' % index, 'a', 0) for index in range(4) ] + [ ('b0', 'b', 0), ('b1', 'b', 0) ]
+        self.assertEqual(self.drain(FairQueue({'a': 2}), items), ['a0', 'a1', 'b0', 'a2', 'a3', 'b1'])
+
+    def test_priorities(self):
+        items = [ ('low0', 'a', 0), ('low1', 'a', 0), ('high0', 'b', 1), ('high1', 'c', 1) ]
+        self.assertEqual(self.drain(FairQueue(), items), ['high0', 'high1', 'low0', 'low1'])
+
+    def test_oldest(self):
+        queue = FairQueue()
+        async def scenario():
+            self.assertIsNone(queue.oldest())
+            await queue.put('a', 'a')
+            await queue.put('b', 'b')
+            enqueued_at, _ = await queue.get()
+            self.assertGreaterEqual(queue.oldest(), enqueued_at)
+            self.assertEqual(len(queue), 1)
+        curio.run(scenario())
+
+    def test_interactive_request_not_starved_by_batch(self):
+        server = FakeSubprocessServer('127.0.0.1', 11111, 'echo', memoized=False, max_workers=1)
+        completed = []
+        async def send(request, flow):
+            await server.dispatch(request, curio.Queue(maxsize=1), flow=flow)
+            completed.append(request['id'])
+        async def scenario():
+            tasks = await server.start()
+            sent = [ await curio.spawn(send({'id': 'batch%d' % index}, 'batch')) for index in range(5) ]
+            await curio.sleep(.05)
+            sent.append( await curio.spawn(send({'id': 'interactive'}, 'interactive')) )
+            for task in sent:
+                await task.join()
+            for task in tasks:
+                await task.cancel()
+        curio.run(scenario())
+        self.assertLess(completed.index('interactive'), 3)
+
+    def test_tenant_weights(self):
+        server = FakeSubprocessServer('127.0.0.1', 11111, 'echo', memoized=False, max_workers=1, tenant_weights={'acme': 2})
+        completed = []
+        async def send(id, tenant):
+            message = json.dumps({CONTROL_KEY: {'tenant': tenant}, 'request': {'id': id}}).encode('utf-8')
+            await server.handle_message(message, curio.Queue(maxsize=1), flow='connection')
+            completed.append(id)
+        async def scenario():
+            tasks = await server.start()
+            # keeps the worker busy while the requests of the tenants are queued
+            sent = [ await curio.spawn(send('first', None)) ]
+            await curio.sleep(.05)
+            sent += [ await curio.spawn(send('a%d' % index, 'acme')) for index in range(4) ]
+            sent += [ await curio.spawn(send('b%d' % index, 'other')) for index in range(4) ]
+            for task in sent:
+                await task.join()
+            for task in tasks:
+                await task.cancel()
+        curio.run(scenario())
+        self.assertEqual(completed, ['first', 'a0', 'a1', 'b0', 'a2', 'a3', 'b1', 'b2', 'b3'])
+
+    def test_client_tenant_and_priority(self):
+        data = {'foo': 'bar'}
+        with server(Parallel.echo, cpus=1, tenant_weights={'acme': 2}):
+            with Client(tenant='acme', priority=1) as client:
+                self.assertEqual(client.send(json.dumps(data)), data)
+
+
+class SharedMemoryTransfer(TestCase):
+
+    def test_segment_pool(self):
+        segments = SegmentPool(max_free=1)
+        attachments = Attachments()
+        try:
+            payload = segments.put(b'x' * 5000)
+            self.assertEqual(attachments.read(payload), b'x' * 5000)
+            segments.release(payload.name)
+            reused = segments.put(b'y' * 6000)
+            self.assertEqual(reused.name, payload.name)
+            self.assertEqual(attachments.read(reused), b'y' * 6000)
+            other = segments.put(b'z' * 100)
+            self.assertNotEqual(other.name, reused.name)
+            segments.release(reused.name)
+            segments.release(other.name)
+            self.assertEqual(len(segments.used), 0)
+        finally:
+            attachments.close()
+            segments.close()
+
+    def evaluate(self, **kwargs):
+        small = {'foo': 'bar'}
+        large = {'code': 'x' * (1 << 20)}
+        with server(Parallel.echo, cpus=1, shared_memory_threshold=1 << 16, **kwargs):
+            with Client(framed=True) as client:
+                self.assertEqual(client.send(json.dumps(large)), large)
+                self.assertEqual(client.send(json.dumps(small)), small)
+                self.assertEqual(client.send(json.dumps(large)), large)
+                counters = client.stats()['metrics']['counters']
+        self.assertEqual(counters['shared_memory_requests'], 2)
+        self.assertEqual(counters['shared_memory_responses'], 2)
+
+    def test_large_payloads(self):
+        self.evaluate()
+
+    def test_preload(self):
+        self.evaluate(preload=True)
+
+
+class Acceptors(TestCase):
+
+    def evaluate(self, **kwargs):
+        data = {'foo': 'bar'}
+        acceptors = set()
+        with server(Parallel.echo, acceptors=2, **kwargs):
+            for _ in range(20):
+                with Client() as client:
+                    self.assertEqual(client.send(json.dumps(data)), data)
+                    acceptors.add(client.stats()['acceptor'])
+        self.assertEqual(acceptors, {0, 1})
+
+    def test_stats_port(self):
+        with server(Parallel.echo, parallel=False, acceptors=2, stats_port=11112):
+            for _ in range(20):
+                with Client() as client:
+                    client.send(json.dumps({}))
+            with socket.create_connection(('127.0.0.1', 11112)) as stats_socket:
+                data = b''
+                while True:
+                    chunk = stats_socket.recv(1 << 13)
+                    if not chunk:
+                        break
+                    data += chunk
+        stats = json.loads(data.decode('utf-8'))['acceptors']
+        self.assertEqual([ acceptor['acceptor'] for acceptor in stats ], [0, 1])
+        self.assertEqual(sum(acceptor['metrics']['counters']['requests'] for acceptor in stats), 20)
+
+    def test_connections_spread_over_acceptors(self):
+        self.evaluate(parallel=False)
+
+    def test_parallel(self):
+        self.evaluate(cpus=1)
+
+
+class AsyncClient(TestCase):
+
+    async def slow_echo(request):
+        await curio.sleep(request.get('sleep', 0))
+        return json.dumps(request)
+
+    async def proxy(request):
+        # calls another server from the handler
+        async with AsyncTcpClient('127.0.0.1', 11111, framed=True) as client:
+            return json.dumps({'proxied': await client.send(json.dumps(request))})
+
+    def evaluate(self, **kwargs):
+        async def main():
+            async with AsyncTcpClient('127.0.0.1', 11111, **kwargs) as client:
+                first = await client.send(json.dumps({'foo': 'bar'}))
+                second = await client.send(json.dumps({'numbers': [1, 2]}))
+                stats = await client.stats()
+            return first, second, stats
+        with server(AsyncClient.slow_echo, parallel=False):
+            first, second, stats = curio.run(main)
+        self.assertEqual(first, {'foo': 'bar'})
+        self.assertEqual(second, {'numbers': [1, 2]})
+        # both requests were sent on the same connection
+        self.assertEqual(stats['metrics']['counters']['connections'], 1)
+
+    def test_json(self):
+        self.evaluate()
+
+    def test_framed(self):
+        self.evaluate(framed=True)
+
+    def test_multiplexed(self):
+        self.evaluate(multiplexed=True)
+
+    def test_concurrent_requests(self):
+        requests = [ json.dumps({'id': number, 'sleep': .5}) for number in range(10) ]
+        async def main():
+            async with AsyncTcpClient('127.0.0.1', 11111, multiplexed=True) as client:
+                start = perf_counter()
+                tasks = [ await curio.spawn(client.send(request)) for request in requests ]
+                replies = [ await task.join() for task in tasks ]
+                replies += await client.send_many(requests)
+                return replies, perf_counter() - start
+        with server(AsyncClient.slow_echo, parallel=False):
+            replies, elapsed = curio.run(main)
+        self.assertEqual(replies, [ json.loads(request) for request in requests ] * 2)
+        self.assertLess(elapsed, 2)
+
+    def test_binary(self):
+        request = {'code': b'import os\n' * 1000, 'context': {'path': 'a.py'}}
+        async def main():
+            replies = []
+            for options in ({'binary': True}, {'binary': True, 'compression_threshold': 1000}, {'binary': True, 'multiplexed': True}, {}):
+                async with AsyncTcpClient('127.0.0.1', 11111, **options) as client:
+                    replies.append(await client.send(request))
+                    replies.append(await client.send(json.dumps({'text': 'x' * 10000})))
+            return replies
+        with server(Codec.describe, parallel=False, binary=True, compression_threshold=1000):
+            replies = curio.run(main)
+        self.assertEqual(replies, [{'code': 'bytes', 'context': 'dict'}, {'text': 'str'}] * 3 + [{'code': 'str', 'context': 'dict'}, {'text': 'str'}])
+
+    def test_timeout_reconnects(self):
+        async def main():
+            async with AsyncTcpClient('127.0.0.1', 11111, timeout=.2) as client:
+                with self.assertRaises(curio.TaskTimeout):
+                    await client.send(json.dumps({'sleep': 1}))
+                return await client.send(json.dumps({'foo': 'bar'}))
+        with server(AsyncClient.slow_echo, parallel=False):
+            self.assertEqual(curio.run(main), {'foo': 'bar'})
+
+    def test_handler_calling_another_server(self):
+        with server(AsyncClient.slow_echo, parallel=False):
+            with server(AsyncClient.proxy, port=11112, cpus=1):
+                with Client(port=11112) as client:
+                    self.assertEqual(client.send(json.dumps({'foo': 'bar'})), {'proxied': {'foo': 'bar'}})
+
+
+class ClientPool(TestCase):
+
+    async def slow_echo(request):
+        await curio.sleep(.3)
+        return json.dumps(request)
+
+    def test_concurrent_threads(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111, max_size=4)
+        replies = {}
+        def send(number):
+            replies[number] = pool.send(json.dumps({'number': number}))
+        with server(ClientPool.slow_echo, parallel=False):
+            start = perf_counter()
+            threads = [ Thread(target=send, args=(number,)) for number in range(8) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = perf_counter() - start
+        pool.close()
+        self.assertEqual(replies, { number: {'number': number} for number in range(8) })
+        # 4 connections handle 2 requests each
+        self.assertLess(elapsed, 1.2)
+        self.assertEqual(pool.pool_stats()['created'], 4)
+
+    def test_reconnect_after_restart(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111, health_check_interval=0)
+        with server(Parallel.echo, parallel=False):
+            self.assertEqual(pool.send(json.dumps({'foo': 'bar'})), {'foo': 'bar'})
+        with server(Parallel.echo, parallel=False):
+            self.assertEqual(pool.send(json.dumps({'foo': 'baz'})), {'foo': 'baz'})
+        stats = pool.pool_stats()
+        pool.close()
+        self.assertEqual((stats['created'], stats['discarded']), (2, 1))
+
+    def test_retry_without_health_check(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111, health_check_interval=60)
+        with server(Parallel.echo, parallel=False):
+            self.assertEqual(pool.send(json.dumps({'foo': 'bar'})), {'foo': 'bar'})
+        with server(Parallel.echo, parallel=False):
+            self.assertEqual(pool.send(json.dumps({'foo': 'baz'})), {'foo': 'baz'})
+        pool.close()
+
+    def test_failing_handler(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111)
+        with server(Parallel.boom):
+            self.assertIsNone(pool.send(json.dumps('')))
+            self.assertIsNone(pool.send(json.dumps('')))
+        stats = pool.pool_stats()
+        pool.close()
+        # the failure of the handler is the reply, the connection is reused rather than retried
+        self.assertEqual((stats['created'], stats['discarded']), (1, 0))
+
+    def test_idle_eviction(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111, idle_timeout=.1)
+        with server(Parallel.echo, parallel=False):
+            pool.send(json.dumps({'foo': 'bar'}))
+            pool.send(json.dumps({'foo': 'bar'}))
+            sleep(.2)
+            pool.send(json.dumps({'foo': 'bar'}))
+        stats = pool.pool_stats()
+        pool.close()
+        self.assertEqual((stats['created'], stats['discarded'], stats['idle']), (2, 1, 1))
+
+    def test_wait_timeout(self):
+        pool = BlockingTcpClientPool('127.0.0.1', 11111, max_size=1, wait_timeout=.1)
+        with server(Parallel.echo, parallel=False):
+            with pool.connection():
+                with self.assertRaises(socket.timeout):
+                    pool.send(json.dumps({'foo': 'bar'}))
+            self.assertEqual(pool.send(json.dumps({'foo': 'bar'})), {'foo': 'bar'})
+        pool.close()
+
+
+class Hedging(TestCase):
+
+    async def slow_echo(request):
+        await curio.sleep(.5)
+        return json.dumps(request)
+
+    async def fast_echo(request):
+        await curio.sleep(.01)
+        return json.dumps(request)
+
+    def test_fastest_replica_preferred(self):
+        client = HedgedTcpClient([('127.0.0.1', 11111), ('127.0.0.1', 11112)])
+        with server(Hedging.slow_echo, parallel=False), server(Hedging.fast_echo, port=11112, parallel=False):
+            replies = [ client.send(json.dumps({'number': number})) for number in range(10) ]
+        stats = client.replica_stats()
+        client.close()
+        self.assertEqual(replies, [ {'number': number} for number in range(10) ])
+        # each replica is measured once, then the fast one gets all the requests
+        self.assertEqual(stats['127.0.0.1:11111']['requests'], 1)
+        self.assertEqual(stats['127.0.0.1:11112']['requests'], 9)
+        self.assertEqual(stats['127.0.0.1:11112']['latency']['count'], 9)
+
+    def test_slow_request_hedged(self):
+        # the slow replica is the only one measured, so it is tried first
+        client = HedgedTcpClient([('127.0.0.1', 11112), ('127.0.0.1', 11111)], hedge_delay=.05)
+        with server(Hedging.slow_echo, port=11112, parallel=False), server(Hedging.fast_echo, parallel=False):
+            start = perf_counter()
+            reply = client.send(json.dumps({'foo': 'bar'}))
+            elapsed = perf_counter() - start
+        stats = client.replica_stats()
+        client.close()
+        self.assertEqual(reply, {'foo': 'bar'})
+        self.assertLess(elapsed, .4)
+        self.assertEqual(stats['127.0.0.1:11111']['hedges'], 1)
+        self.assertEqual(stats['127.0.0.1:11111']['wins'], 1)
+
+    stall = 0
+
+    async def stalling_echo(request):
+        await curio.sleep(Hedging.stall if request.get('stall') else .01)
+        return json.dumps(request)
+
+    def test_hedge_after_percentile(self):
+        client = HedgedTcpClient([('127.0.0.1', 11111), ('127.0.0.1', 11112)], min_samples=5)
+        Hedging.stall = 1
+        with server(Hedging.stalling_echo, parallel=False):
+            Hedging.stall = .01
+            with server(Hedging.stalling_echo, port=11112, parallel=False):
+                for number in range(20):
+                    client.send(json.dumps({'number': number}))
+                primary = client.ranked()[0]
+                start = perf_counter()
+                reply = client.send(json.dumps({'stall': True}))
+                elapsed = perf_counter() - start
+        stats = client.replica_stats()
+        client.close()
+        self.assertEqual(reply, {'stall': True})
+        self.assertLess(elapsed, .5)
+        if primary.port == 11111:
+            self.assertEqual(stats['127.0.0.1:11112']['wins'], 1)
+
+    def test_failover(self):
+        client = HedgedTcpClient([('127.0.0.1', 11113), ('127.0.0.1', 11111)])
+        with server(Hedging.fast_echo, parallel=False):
+            replies = [ client.send(json.dumps({'number': number})) for number in range(3) ]
+        stats = client.replica_stats()
+        client.close()
+        self.assertEqual(replies, [ {'number': number} for number in range(3) ])
+        # the replica that is down is only tried once
+        self.assertEqual(stats['127.0.0.1:11113']['errors'], 1)
+
+
+class Codec(TestCase):
+
+    def test_round_trip(self):
+        values = [
+            None, True, False, 0, -1, 127, -128, 128, 1 << 62, -(1 << 63), 1 << 100, -(1 << 100), 1.5,
+            '', 'numpy', 'é' * 300, b'', b'\x00\xff' * 1000, [], [1, [2, None]], {},
+            {'code': b'import os', 'context': {'path': 'a.py', 'private_modules': ['a', 'b']}, 1: 'one'},
+        ]
+        for value in values:
+            self.assertEqual(codec.loads(codec.dumps(value)), value)
+        self.assertEqual(codec.loads(codec.dumps((1, 2))), [1, 2])
+
+    def test_invalid(self):
+        data = codec.dumps({'code': b'import os'})
+        for invalid in (data[:-1], data + b'\x00', b'\xff', b''):
+            with self.assertRaises(ValueError):
+                codec.loads(invalid)
+        # a truncated string is invalid as soon as it is decoded, not only once the whole message is
+        with self.assertRaises(IndexError):
+            codec.decode(memoryview(codec.dumps('numpy')[:-1]), 0)
+        with self.assertRaises(TypeError):
+            codec.dumps({'set': set()})
+
+    def test_compression(self):
+        encoding = codec.Encoding(binary=True, compression=True, compression_threshold=100)
+        small, large = b'x' * 10, b'x' * 1000
+        self.assertEqual(encoding.pack(small), b'\x00' + small)
+        packed = encoding.pack(large, binary=True)
+        self.assertLess(len(packed), 100)
+        self.assertEqual(packed[0], codec.FLAG_ZLIB | codec.FLAG_BINARY)
+        self.assertEqual(encoding.unpack(packed), (large, True))
+        with self.assertRaises(ValueError):
+            encoding.unpack(bytes((codec.FLAG_ZLIB,)) + large)
+
+    async def describe(request):
+        # the type each value reached the handler as
+        return json.dumps({ key: type(value).__name__ for key, value in request.items() })
+
+    def evaluate(self, server_options, client_options, expected):
+        request = {'code': b'import os\n' * 1000, 'context': {'path': 'a.py'}}
+        with server(Codec.describe, parallel=False, **server_options):
+            with Client(**client_options) as client:
+                self.assertEqual(client.send(request), expected)
+                self.assertEqual(client.send(json.dumps({'text': 'x' * 10000})), {'text': 'str'})
+                self.assertEqual(client.stats()['metrics']['counters']['requests'], 3)
+
+    def test_binary(self):
+        self.evaluate({'binary': True}, {'binary': True}, {'code': 'bytes', 'context': 'dict'})
+
+    def test_binary_compressed(self):
+        self.evaluate({'binary': True, 'compression_threshold': 1000}, {'binary': True, 'compression_threshold': 1000}, {'code': 'bytes', 'context': 'dict'})
+
+    def test_binary_multiplexed_with_envelope(self):
+        self.evaluate({'binary': True}, {'binary': True, 'multiplexed': True, 'tenant': 'acme'}, {'code': 'bytes', 'context': 'dict'})
+
+    def test_server_without_binary(self):
+        # bytes are then sent as base64 encoded text, as before
+        self.evaluate({}, {'binary': True, 'compression_threshold': 1000}, {'code': 'str', 'context': 'dict'})
+
+    def test_json_client(self):
+        self.evaluate({'binary': True, 'compression_threshold': 1000}, {}, {'code': 'str', 'context': 'dict'})
+
+    def test_binary_raw_cache_keys(self):
+        with server(Parallel.echo, parallel=False, memoized=True, raw_cache_keys=True, binary=True):
+            with Client(binary=True) as client:
+                # the last byte of these values is a whitespace character
+                for value in (9, 10, 32, ' '):
+                    self.assertEqual(client.send({'a': value}), {'a': value})
+                self.assertEqual(client.send(json.dumps({'a': 9})), {'a': 9})
+
+    def test_malformed_binary_frame(self):
+        # a dict whose key is a list
+        malformed = b'\x0b\x00\x00\x00\x01\x0a\x00\x00\x00\x00\x00'
+        with self.assertRaises(ValueError):
+            codec.loads(malformed)
+        for options in ({'binary': True}, {'binary': True, 'multiplexed': True}):
+            with server(Codec.describe, parallel=False, binary=True):
+                with Client(**options) as client:
+                    if client.multiplexed:
+                        client.socket.sendall(protocol.frame(client.encoding.pack(malformed, binary=True), 1))
+                        self.assertEqual(client.read_frame()[1]['error'], 'InvalidRequest')
+                    else:
+                        client.socket.sendall(protocol.frame(client.encoding.pack(malformed, binary=True)))
+                        self.assertEqual(client.read()['error'], 'InvalidRequest')
+                    self.assertEqual(client.send({'a': b'1'}), {'a': 'bytes'})
 
+    def test_binary_not_negotiated(self):
+        with server(Codec.describe, parallel=False, compression_threshold=1000):
+            with Client(compression_threshold=1000) as client:
+                client.socket.sendall(protocol.frame(client.encoding.pack(codec.dumps({'a': 1}), binary=True)))
+                self.assertEqual(client.read()['error'], 'InvalidRequest')
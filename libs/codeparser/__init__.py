@@ -1,5 +1,8 @@
 from . import exceptions
 from .parserhealth import ParserHealth
+from .relevance import RelevanceOracle
+from .privatemodules import PrivateModuleIndex, PrivateModuleIndexes
+from .dialects import DialectRouter
 from .languageparser import LanguageParser
 from .pythonparser import PythonParser
 from .javascriptparser import JavascriptParser
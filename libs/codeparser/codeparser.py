@@ -11,10 +11,12 @@ LOGGER = logging.getLogger()
 
 class CodeParser(object):
 
-    def __init__(self, callback):
+    def __init__(self, callback, binary = False, cache_directory = None, relevance_snapshots = None, multiplexed_impact = False):
         self.parsers = {}
+        relevance_snapshots = relevance_snapshots or {}
         for parser in [PythonParser, JavascriptParser]:
-            self.parsers[parser.language] = parser(callback = callback)
+            self.parsers[parser.language] = parser(callback = callback, binary = binary, cache_directory = cache_directory,
+                                                   relevance_snapshot = relevance_snapshots.get(parser.language), multiplexed_impact = multiplexed_impact)
         self.mimetypes = mimetypes.MimeTypes(strict = False)
         self.mimetypes.add_type('application/javascript','.jsx', strict = False)
         self.mimetype_regex = re.compile('(?:application|text)\/(?:(?:x-)?)(?P<language>[a-z]+)$')
@@ -60,6 +62,9 @@ class CodeParser(object):
         for blob in commit.tree.traverse(predicate = lambda item, depth: item.type == 'blob', visit_once = True):
             self.get_parser(blob.path).analyze_blob(repo_name, commit, blob.path)
 
+    def dialect_stats(self):
+        return { language: parser.dialect_stats() for language, parser in self.parsers.items() if parser.dialect_stats() is not None }
+
     def close(self):
         for parser in self.parsers.values():
             parser.close()
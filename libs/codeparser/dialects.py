@@ -0,0 +1,84 @@
+import os
+import threading
+
+from collections import Counter, OrderedDict
+
+DECAY = .9 # weight of the past outcomes of a prefix against the latest one, so a repository migrating to a dialect is soon routed to it
+
+
+class DialectRouter(object):
+    '''
+    Remembers which dialect parsed the files of each repository, and of each directory of a repository,
+    so the files of a mixed history are sent straight to the parser of the dialect most likely to parse them,
+    rather than to the parser of whichever dialect parsed the previous file.
+    Files are routed by the outcomes of the deepest of their directories with any, then of the whole repository,
+    then of all repositories, and in the order of 'dialects' otherwise.
+    '''
+    def __init__(self, dialects, max_entries = 1 << 16):
+        '''
+            dialects:       names of the dialects, in the order to try them in when nothing is known of a file.
+            max_entries:    maximum number of repositories and directories remembered. Defaults to 65536.
+        '''
+        self.dialects = list(dialects)
+        self.max_entries = max_entries
+        self.scores = OrderedDict() # (repository, directory) -> { dialect: decayed count of the files it parsed }
+        self.lock = threading.Lock()
+        self.routed = Counter() # files first sent to each dialect
+        self.fallbacks = Counter() # files first sent to each dialect and parsed by another one, or by none
+
+    @staticmethod
+    def prefixes(repo_name, path):
+        '''
+        Returns the keys of the directories of 'path', deepest first, then of its repository and of all repositories.
+        '''
+        directory = os.path.dirname(path or '')
+        while directory:
+            yield (repo_name, directory)
+            directory = os.path.dirname(directory)
+        yield (repo_name, '')
+        yield (None, '')
+
+    def order(self, repo_name, path):
+        '''
+        Returns the dialects, in the order to try them in to parse 'path'.
+        '''
+        with self.lock:
+            for key in self.prefixes(repo_name, path):
+                scores = self.scores.get(key)
+                if scores:
+                    self.scores.move_to_end(key)
+                    return sorted(self.dialects, key = lambda dialect: -scores.get(dialect, 0))
+        return list(self.dialects)
+
+    def record(self, repo_name, path, first, dialect):
+        '''
+        Records that 'path' was first sent to the parser of 'first', and parsed by the parser of 'dialect', None if it wasn't.
+        '''
+        with self.lock:
+            self.routed[first] += 1
+            if dialect != first:
+                self.fallbacks[first] += 1
+            if dialect is None:
+                return
+            for key in self.prefixes(repo_name, path):
+                scores = self.scores.pop(key, {})
+                for other in scores:
+                    scores[other] *= DECAY
+                scores[dialect] = scores.get(dialect, 0) + 1
+                self.scores[key] = scores
+            while len(self.scores) > self.max_entries:
+                self.scores.popitem(last = False)
+
+    def stats(self):
+        '''
+        Returns, by dialect, the number of files first sent to its parser, and the number and rate of those that another parser had to parse.
+        '''
+        with self.lock:
+            return {
+                dialect: {
+                    'routed': self.routed[dialect],
+                    'fallbacks': self.fallbacks[dialect],
+                    'fallback_rate': self.fallbacks[dialect] / self.routed[dialect] if self.routed[dialect] else 0,
+                }
+                for dialect in self.dialects
+            }
@@ -1,4 +1,4 @@
-from asynctcp import BlockingTcpClient
+from asynctcp import BlockingTcpClientPool
 
 from . import LanguageParser
 
@@ -10,10 +10,10 @@ IMPACT_PORT = 9999
 class JavascriptParser(LanguageParser):
     language = 'javascript'
 
-    def __init__(self, callback):
-        super().__init__(callback)
+    def __init__(self, callback, binary = False, cache_directory = None, relevance_snapshot = None, multiplexed_impact = False):
+        super().__init__(callback, binary, cache_directory, relevance_snapshot = relevance_snapshot, multiplexed_impact = multiplexed_impact)
         self.parsers = []
-        self.parsers.append(BlockingTcpClient(PARSER_HOST, PARSER_PORT, timeout = 120))
+        self.parsers.append(BlockingTcpClientPool(PARSER_HOST, PARSER_PORT, timeout = 120, binary = binary))
 
     def get_context(self, repo_name, commit, path):
         return super().get_context(repo_name, commit, path)
@@ -24,5 +24,5 @@ class JavascriptParser(LanguageParser):
     @property
     def relevance_checker(self):
         if not hasattr(self, '_relevance_checker'):
-            self._relevance_checker = BlockingTcpClient(IMPACT_HOST, IMPACT_PORT, timeout = 20)
+            self._relevance_checker = BlockingTcpClientPool(IMPACT_HOST, IMPACT_PORT, timeout = 20, multiplexed = self.multiplexed_impact)
         return self._relevance_checker
@@ -1,55 +1,151 @@
 import abc
+import os
 import json
 import base64
 import logging
+import threading
 
-from functools import lru_cache
+from hashlib import blake2b
 from collections import Counter
 
+from asynctcp import ResponseCache, SharedResponseCache, TieredCache
+
 from . import exceptions
+from .relevance import RelevanceOracle
 
 LOGGER = logging.getLogger()
 
 class LanguageParser(metaclass = abc.ABCMeta):
+    # bumped when the parser servers change the results they return for the same code, so cached results are discarded
+    parser_version = 1
 
     @classmethod
     def _log_callback(cls, *args, date, count):
         LOGGER.debug(*args, date, count)
 
-    def __init__(self, callback = _log_callback):
+    def __init__(self, callback = _log_callback, binary = False, cache_directory = None, cache_size = 1 << 14, relevance_snapshot = None, multiplexed_impact = False):
+        '''
+            binary:             if True, the code is sent to parsers that accept the binary encoding as bytes rather than base64 encoded text,
+                                see asynctcp.codec. Parsers that don't still get base64 encoded text.
+            cache_directory:    if set, parse results are also cached in a database of this directory,
+                                shared with the other scans of the host and kept from one scan to the next.
+            cache_size:         maximum number of parse results cached in memory. Defaults to 16384.
+            relevance_snapshot: path of a snapshot of the relevance of popular modules, see RelevanceOracle.
+            multiplexed_impact: if True, negotiate multiplexed connections with the impact server, so the relevance
+                                of all the modules of a file takes a single round trip. Only enable it if the impact server
+                                supports it, since otherwise each new connection waits for the negotiation to time out.
+        '''
         self.callback = callback
+        self.binary = binary
+        self.relevance_snapshot = relevance_snapshot
+        self.multiplexed_impact = multiplexed_impact
+        self._relevance = None
+        # parse results by blob, see 'parse_key'. The caches aren't thread-safe, hence the lock.
+        self.parse_cache_lock = threading.Lock()
+        self.parse_cache = ResponseCache(max_entries = cache_size, max_bytes = 1 << 26)
+        if cache_directory:
+            self.parse_cache = TieredCache(
+                self.parse_cache,
+                SharedResponseCache(os.path.join(cache_directory, self.language + '.sqlite'), version = self.parser_version),
+            )
+        self.parsers_lock = threading.Lock()
+        # names of the dialects of the language, one per parser, in the order of 'parsers', routed by 'router' if set
+        self.dialects = None
+        self.router = None
 
     @abc.abstractmethod
     def get_context(self, repo_name, commit, path):
         return { 'path': path, 'url': self.get_commit_url_path(repo_name, commit, path) }
 
-    def parse(self, code, context = None):
-        request = json.dumps(
-            {
-                'code':     base64.b64encode(code).decode('utf-8'),
-                'context':  context
-            }
-        )
-        for index, parser in enumerate(self.parsers):
-            response = parser.send(request)
-            if response and 'error' not in response:
-                break
+    def parse(self, code, context = None, repo_name = None):
+        if self.binary:
+            request = { 'code': code, 'context': context }
         else:
-            raise exceptions.UnparsableCode(self.language, context['url'], response['message'] if 'message' in response else None)
-        self.parsers.insert(0, self.parsers.pop(index))
+            request = json.dumps(
+                {
+                    'code':     base64.b64encode(code).decode('utf-8'),
+                    'context':  context
+                }
+            )
+        if self.router is not None:
+            return self.parse_routed(request, context, repo_name)
+        # parsers may be called from several threads, each one trying them in the order they were in when it started
+        parser, response = self.try_parsers(list(self.parsers), request, context)
+        with self.parsers_lock:
+            self.parsers.remove(parser)
+            self.parsers.insert(0, parser)
+        return response
+
+    def parse_routed(self, request, context, repo_name):
+        '''
+        Tries the parser of each dialect in the order the router expects them to succeed in for the repository and path of the code.
+        '''
+        path = context['path'] if context else None
+        parsers = dict(zip(self.dialects, self.parsers))
+        order = self.router.order(repo_name, path)
+        try:
+            parser, response = self.try_parsers([ parsers[dialect] for dialect in order ], request, context)
+        except:
+            self.router.record(repo_name, path, order[0], None)
+            raise
+        self.router.record(repo_name, path, order[0], self.dialects[self.parsers.index(parser)])
         return response
 
+    def try_parsers(self, parsers, request, context):
+        '''
+        Sends the request to each parser in turn until one parses the code, and returns that parser and its response.
+        A parser that fails to reply is skipped. Raises UnparsableCode if no parser parsed the code,
+        or the error of the last parser if none of them replied.
+        '''
+        error = None
+        reply = None
+        for parser in parsers:
+            try:
+                response = parser.send(request)
+            except Exception as exc:
+                LOGGER.warning('A {} parser failed, trying the next one: {!r}'.format(self.language, exc))
+                error = exc
+                continue
+            if isinstance(response, dict) and response and 'error' not in response:
+                return parser, response
+            reply = response if isinstance(response, dict) else {}
+        if reply is None and error is not None:
+            raise error
+        raise exceptions.UnparsableCode(self.language, context['url'] if context else None, (reply or {}).get('message'))
+
+    def dialect_stats(self):
+        '''
+        Returns the routing stats of each dialect, see DialectRouter.stats, or None if the language has a single one.
+        '''
+        return self.router.stats() if self.router is not None else None
+
     def close(self):
         self.relevance_checker.close()
         for parser in self.parsers:
             parser.close()
 
-    @lru_cache()
     def get_module_counts(self, repo_name, commit, path):
-        code = commit.tree[path].data_stream.read()
+        blob = commit.tree[path]
         context = self.get_context(repo_name, commit, path)
-        use_count = self.parse(code, context)['use_count']
-        return Counter({ name: count for name, count in use_count.items() if self.check_relevance(name) })
+        key = self.parse_key(blob.hexsha, context)
+        with self.parse_cache_lock:
+            cached = self.parse_cache.get(key)
+        if cached is None:
+            use_count = self.parse(blob.data_stream.read(), context, repo_name)['use_count']
+            with self.parse_cache_lock:
+                self.parse_cache.put(key, json.dumps(use_count).encode('utf-8'))
+        else:
+            use_count = json.loads(cached.decode('utf-8'))
+        relevance = self.relevance.check(use_count.keys())
+        return Counter({ name: count for name, count in use_count.items() if relevance[name] })
+
+    def parse_key(self, hexsha, context):
+        '''
+        Key of the parse result of a blob, the same in every commit, branch and fork the blob appears in with the same context.
+        The url of the blob is only used in error messages, so it isn't part of the key.
+        '''
+        context = json.dumps({ name: value for name, value in context.items() if name != 'url' }, sort_keys = True)
+        return '{}:{}:{}'.format(self.parser_version, hexsha, blake2b(context.encode('utf-8'), digest_size = 16).hexdigest())
 
     def get_commit_url_path(self, repo_name, commit, path):
         return 'https://github.com/{fullname}/blob/{hexsha}/{path}'.format(fullname = repo_name, hexsha = commit.hexsha, path = path)
@@ -59,15 +155,15 @@ class LanguageParser(metaclass = abc.ABCMeta):
     def relevance_checker(self):
         pass
 
+    @property
+    def relevance(self):
+        if self._relevance is None:
+            self._relevance = RelevanceOracle(self.relevance_checker, snapshot = self.relevance_snapshot)
+        return self._relevance
+
     @abc.abstractmethod
     def check_relevance(self, module):
-        if module.split('.')[0] == '__stdlib__':
-            return True
-        elif module.split('.')[0] == '__private__':
-            return False
-        else:
-            relevance = int(self.relevance_checker.send(json.dumps({ 'module': module.split('.')[0] }))['impact'])
-            return bool(relevance > 0)
+        return self.relevance.check([module])[module]
 
     def analyze_blob(self, repo_name, commit, path):
         module_counts = self.get_module_counts(repo_name, commit, path)
@@ -0,0 +1,137 @@
+import os
+import bisect
+import threading
+
+from collections import OrderedDict
+
+def is_package(path):
+    return path.endswith('__init__.py')
+
+
+class PrivateModuleIndex(object):
+    '''
+    The packages of a tree, i.e. the directories holding an '__init__.py', from which the modules private to the repository
+    are derived for each of its files, see 'modules'.
+    Each package is importable by its path without its top-level directory, e.g. 'src/foo/bar' as 'foo.bar',
+    and relatively to the files of the same top-level directory, e.g. as 'bar' from 'src/foo/baz.py'.
+    '''
+    def __init__(self, packages):
+        self.packages = frozenset(packages)
+        # absolute paths, sorted so those under a directory are found by bisection, by top-level directory
+        self.absolute_paths = {}
+        for package in self.packages:
+            top = package.split('/')[0]
+            self.absolute_paths.setdefault(top, []).append(self.absolute_path(package))
+        for paths in self.absolute_paths.values():
+            paths.sort()
+        self.absolute_modules = { self.module_name(path) for paths in self.absolute_paths.values() for path in paths }
+        self.modules_by_directory = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def strip_top(path, top):
+        base = top + '/'
+        return path[len(base):] if path.startswith(base) else path
+
+    @classmethod
+    def absolute_path(cls, package):
+        return cls.strip_top(package, package.split('/')[0]) + '/'
+
+    @staticmethod
+    def module_name(path):
+        return path.replace('/', '.').strip('.') or '.'
+
+    @classmethod
+    def from_tree(cls, tree):
+        return cls(
+            os.path.dirname(blob.path)
+            for blob in tree.traverse(predicate = lambda item, depth: item.type == 'blob' and is_package(item.path))
+        )
+
+    def updated(self, diffs):
+        '''
+        Returns the index of the tree 'diffs' lead to from the tree of this index.
+        '''
+        packages = set(self.packages)
+        for diff in diffs:
+            if diff.a_blob is not None and is_package(diff.a_path):
+                packages.discard(os.path.dirname(diff.a_path))
+            if diff.b_blob is not None and is_package(diff.b_path):
+                packages.add(os.path.dirname(diff.b_path))
+        return type(self)(packages)
+
+    def modules(self, from_path):
+        '''
+        Returns the sorted names of the private modules, absolute and relative to 'from_path'.
+        '''
+        directory = os.path.dirname(from_path)
+        with self.lock:
+            if directory in self.modules_by_directory:
+                return self.modules_by_directory[directory]
+        modules = set(self.absolute_modules)
+        for top, paths in self.absolute_paths.items():
+            current_path = self.strip_top(directory, top) + '/'
+            start = bisect.bisect_left(paths, current_path)
+            for path in paths[start:]:
+                if not path.startswith(current_path):
+                    break
+                modules.add(self.module_name(path[len(current_path):]))
+        modules = sorted(modules)
+        with self.lock:
+            self.modules_by_directory[directory] = modules
+        return modules
+
+
+class PrivateModuleIndexes(object):
+    '''
+    The PrivateModuleIndex of the latest trees, by tree SHA.
+    The index of a commit's tree is derived from the index of its parent's tree and their diff when it is known,
+    so the commits of a history are indexed without traversing each of their trees.
+    '''
+    def __init__(self, max_entries = 64):
+        self.max_entries = max_entries
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+        self.built = 0
+        self.updated = 0
+
+    def get(self, hexsha):
+        with self.lock:
+            index = self.indexes.get(hexsha)
+            if index is not None:
+                self.indexes.move_to_end(hexsha)
+            return index
+
+    def put(self, hexsha, index):
+        with self.lock:
+            self.indexes[hexsha] = index
+            self.indexes.move_to_end(hexsha)
+            while len(self.indexes) > self.max_entries:
+                self.indexes.popitem(last = False)
+
+    def index(self, commit):
+        index = self.get(commit.tree.hexsha)
+        if index is not None:
+            return index
+        parent = commit.parents[0] if commit.parents else None
+        parent_index = self.get(parent.tree.hexsha) if parent is not None else None
+        if parent_index is None:
+            return self.index_tree(commit.tree)
+        index = parent_index.updated(parent.tree.diff(commit.tree))
+        with self.lock:
+            self.updated += 1
+        self.put(commit.tree.hexsha, index)
+        return index
+
+    def index_tree(self, tree):
+        index = self.get(tree.hexsha)
+        if index is None:
+            index = PrivateModuleIndex.from_tree(tree)
+            with self.lock:
+                self.built += 1
+            self.put(tree.hexsha, index)
+        return index
+
+    def stats(self):
+        with self.lock:
+            return { 'size': len(self.indexes), 'built': self.built, 'updated': self.updated }
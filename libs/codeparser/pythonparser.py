@@ -1,12 +1,11 @@
-import re
 import os
 import logging
-import itertools
-from functools import reduce, lru_cache
 
-from asynctcp import BlockingTcpClient
+from asynctcp import BlockingTcpClientPool
 
 from . import LanguageParser
+from .privatemodules import PrivateModuleIndexes
+from .dialects import DialectRouter
 
 PY3_HOST = 'python_parser'
 PY3_PORT = 25252
@@ -21,11 +20,14 @@ LOGGER = logging.getLogger()
 class PythonParser(LanguageParser):
     language = 'python'
 
-    def __init__(self, callback):
-        super().__init__(callback)
+    def __init__(self, callback, binary = False, cache_directory = None, relevance_snapshot = None, multiplexed_impact = False):
+        super().__init__(callback, binary, cache_directory, relevance_snapshot = relevance_snapshot, multiplexed_impact = multiplexed_impact)
+        self.private_module_indexes = PrivateModuleIndexes()
         self.parsers = []
-        self.parsers.append(BlockingTcpClient(PY3_HOST, PY3_PORT, timeout = 60))
-        self.parsers.append(BlockingTcpClient(PY2_HOST, PY2_PORT, timeout = 60))
+        self.parsers.append(BlockingTcpClientPool(PY3_HOST, PY3_PORT, timeout = 60, binary = binary))
+        self.parsers.append(BlockingTcpClientPool(PY2_HOST, PY2_PORT, timeout = 60, binary = binary))
+        self.dialects = ['python3', 'python2']
+        self.router = DialectRouter(self.dialects)
 
     def _relative_module_name(self, current_path, module_path):
         # TODO: Improve so that it provides relative imports as well (e.g. from ..foo import bar)
@@ -34,24 +36,11 @@ class PythonParser(LanguageParser):
         return relative_module or '.'
 
     def get_context(self, repo_name, commit, path):
-        private_modules = self.get_private_modules(commit.tree, path)
+        private_modules = self.private_module_indexes.index(commit).modules(path)
         return {**super().get_context(repo_name, commit, path), **{'private_modules': private_modules} }
 
     def get_private_modules(self, tree, from_path):
-        # TODO: Clean this up...
-        modules = set()
-        for blob in tree.traverse(predicate = lambda item, depth: item.type == 'blob' and item.path.endswith('.py')):
-            if not blob.path.endswith('__init__.py') and os.path.dirname(blob.path) not in modules:
-                continue
-            module_path = os.path.dirname(blob.path) if blob.path.endswith('__init__.py') else os.path.splitext(blob.path)[0]
-            possible_base_paths = itertools.accumulate(module_path.split('/'), os.path.join)
-            base_path = (list(itertools.takewhile(lambda path: path not in modules, possible_base_paths)) or [''])[0] +'/'
-            absolute_path = re.sub('^' + re.escape(base_path), '', os.path.dirname(blob.path)) + '/'
-            current_path = re.sub('^' + re.escape(base_path), '', os.path.dirname(from_path)) + '/'
-            relative_path = re.sub('^' + re.escape(current_path), '', absolute_path)
-            modules.add(absolute_path)
-            modules.add(relative_path)
-        return sorted(tuple(module.replace('/','.').strip('.') or '.' for module in modules))
+        return self.private_module_indexes.index_tree(tree).modules(from_path)
 
     def check_relevance(self, module):
         return super().check_relevance(module)
@@ -59,5 +48,5 @@ class PythonParser(LanguageParser):
     @property
     def relevance_checker(self):
         if not hasattr(self, '_relevance_checker'):
-            self._relevance_checker = BlockingTcpClient(IMPACT_HOST, IMPACT_PORT, timeout = 60)
+            self._relevance_checker = BlockingTcpClientPool(IMPACT_HOST, IMPACT_PORT, timeout = 60, multiplexed = self.multiplexed_impact)
         return self._relevance_checker
@@ -0,0 +1,110 @@
+import json
+import logging
+import threading
+from time import monotonic
+
+from asynctcp import ResponseCache
+
+LOGGER = logging.getLogger()
+
+RELEVANT = b'1'
+IRRELEVANT = b'0'
+
+
+class RelevanceOracle(object):
+    '''
+    Tells whether modules are relevant, i.e. whether the impact server gives their top-level package a positive impact.
+    Answers are cached for 'ttl' seconds. The top-level packages of a batch of modules that aren't cached
+    are all sent to the impact server at once, which takes a single round trip if its connection is multiplexed, see LanguageParser's multiplexed_impact.
+    The cache can be prewarmed from a snapshot of the impacts of popular packages, see 'save_snapshot'.
+    A package the impact server fails to reply about is taken as irrelevant, and asked about again next time.
+    '''
+    def __init__(self, client, ttl = 24 * 3600, max_entries = 1 << 16, snapshot = None):
+        '''
+            client:         client of the impact server, see asynctcp.BlockingTcpClientPool.
+            ttl:            seconds an answer of the impact server is cached for. Defaults to a day.
+            max_entries:    maximum number of cached answers. Defaults to 65536.
+            snapshot:       path of a snapshot to prewarm the cache with, if set.
+        '''
+        self.client = client
+        self.cache = ResponseCache(max_entries = max_entries, ttl = ttl)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        if snapshot:
+            self.load_snapshot(snapshot)
+
+    @staticmethod
+    def package(module):
+        return module.split('.')[0]
+
+    def check(self, modules):
+        '''
+        Returns a dict of module -> True if it is relevant.
+        '''
+        packages = { self.package(module) for module in modules }
+        relevance = {}
+        with self.lock:
+            for package in packages:
+                if package == '__stdlib__':
+                    relevance[package] = True
+                elif package == '__private__':
+                    relevance[package] = False
+                else:
+                    cached = self.cache.get(package)
+                    if cached is not None:
+                        relevance[package] = cached == RELEVANT
+        unknown = sorted(packages - relevance.keys())
+        if unknown:
+            replies = self.client.send_many([ json.dumps({ 'module': package }) for package in unknown ])
+            with self.lock:
+                self.requests += len(unknown)
+                for package, reply in zip(unknown, replies):
+                    impact = self.impact(reply)
+                    if impact is None:
+                        LOGGER.warning('No impact for package {}: {!r}'.format(package, reply))
+                        self.errors += 1
+                        relevance[package] = False
+                        continue
+                    relevance[package] = impact > 0
+                    self.cache.put(package, RELEVANT if relevance[package] else IRRELEVANT)
+        return { module: relevance[self.package(module)] for module in modules }
+
+    @staticmethod
+    def impact(reply):
+        '''
+        Returns the impact in a reply of the impact server, None if it is missing, e.g. the reply is an error.
+        '''
+        try:
+            return int(reply['impact'])
+        except (TypeError, KeyError, ValueError):
+            return
+
+    def load_snapshot(self, path):
+        '''
+        Caches the impacts of the snapshot at 'path', a JSON object of top-level package -> impact.
+        '''
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        with self.lock:
+            for package, impact in snapshot.items():
+                self.cache.put(package, RELEVANT if int(impact) > 0 else IRRELEVANT)
+        LOGGER.info('Prewarmed the relevance of {} packages from {}'.format(len(snapshot), path))
+
+    def save_snapshot(self, path):
+        '''
+        Writes the cached answers to 'path', as a snapshot to prewarm other oracles with.
+        '''
+        now = monotonic()
+        with self.lock:
+            snapshot = {
+                package: int(answer == RELEVANT)
+                for package, (expiration, answer) in self.cache.entries.items()
+                if expiration is None or expiration > now
+            }
+        with open(path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file, sort_keys = True)
+
+    def stats(self):
+        with self.lock:
+            return { **self.cache.stats(), 'requests': self.requests, 'errors': self.errors }
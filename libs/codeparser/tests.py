@@ -1,11 +1,18 @@
 import io
+import base64
+import hashlib
+import json
 import datetime
 import unittest
 import functools
+import tempfile
+import time
+import os
 
 from collections import defaultdict
 
-from . import CodeParser
+from . import exceptions
+from . import CodeParser, DialectRouter, JavascriptParser, PythonParser, PrivateModuleIndex, RelevanceOracle
 
 class FakeGitBlob(io.BytesIO):
     @property
@@ -67,5 +74,278 @@ class TestCodeParser(unittest.TestCase):
     def tearDown(self):
         self.parser.close()
 
+class FakeBlob(object):
+    def __init__(self, hexsha, code):
+        self.hexsha = hexsha
+        self.code = code
+
+    @property
+    def data_stream(self):
+        return io.BytesIO(self.code)
+
+class FakeCommit(object):
+    def __init__(self, hexsha, **blobs):
+        self.hexsha = hexsha
+        self.tree = blobs
+
+class CountingParserClient(object):
+    def __init__(self):
+        self.requests = 0
+
+    def send(self, request):
+        self.requests += 1
+        return { 'use_count': { '__stdlib__.os': 1, '__private__.foo': 2 } }
+
+    def close(self):
+        pass
+
+class TestParseCache(unittest.TestCase):
+
+    def parser(self, **kwargs):
+        parser = JavascriptParser(callback = None, **kwargs)
+        parser.parsers = [ CountingParserClient() ]
+        return parser
+
+    def test_blob_parsed_once(self):
+        parser = self.parser()
+        blob = FakeBlob('a' * 40, b'import os from "os"')
+        for commit in ( FakeCommit('1' * 40, **{ 'foo.js': blob }), FakeCommit('2' * 40, **{ 'foo.js': blob }) ):
+            self.assertEqual(parser.get_module_counts('rebase/foo', commit, 'foo.js'), { '__stdlib__.os': 1 })
+        # another path is another context
+        parser.get_module_counts('rebase/foo', FakeCommit('3' * 40, **{ 'bar.js': blob }), 'bar.js')
+        self.assertEqual(parser.parsers[0].requests, 2)
+
+    def test_cache_directory(self):
+        blob = FakeBlob('a' * 40, b'import os from "os"')
+        with tempfile.TemporaryDirectory() as directory:
+            self.parser(cache_directory = directory).get_module_counts('rebase/foo', FakeCommit('1' * 40, **{ 'foo.js': blob }), 'foo.js')
+            parser = self.parser(cache_directory = directory)
+            self.assertEqual(parser.get_module_counts('rebase/bar', FakeCommit('2' * 40, **{ 'foo.js': blob }), 'foo.js'), { '__stdlib__.os': 1 })
+            self.assertEqual(parser.parsers[0].requests, 0)
+
+class FakeImpactClient(object):
+    def __init__(self, **impacts):
+        self.impacts = impacts
+        self.batches = []
+
+    def send_many(self, requests):
+        modules = [ json.loads(request)['module'] for request in requests ]
+        self.batches.append(modules)
+        # a package whose impact is None fails on the impact server
+        return [ None if self.impacts.get(module, 0) is None else { 'impact': self.impacts.get(module, 0) } for module in modules ]
+
+    def close(self):
+        pass
+
+class TestRelevanceOracle(unittest.TestCase):
+
+    def test_batched(self):
+        client = FakeImpactClient(react = 10, lodash = 3)
+        oracle = RelevanceOracle(client)
+        relevance = oracle.check(['react.Component', 'react.PropTypes', 'lodash.map', 'leftpad', '__stdlib__.os', '__private__.foo'])
+        self.assertEqual(relevance, {
+            'react.Component': True, 'react.PropTypes': True, 'lodash.map': True,
+            'leftpad': False, '__stdlib__.os': True, '__private__.foo': False,
+        })
+        self.assertEqual(client.batches, [['leftpad', 'lodash', 'react']])
+
+    def test_cached(self):
+        client = FakeImpactClient(react = 10)
+        oracle = RelevanceOracle(client)
+        oracle.check(['react.Component', 'leftpad'])
+        self.assertEqual(oracle.check(['react.Children', 'leftpad', 'redux']), { 'react.Children': True, 'leftpad': False, 'redux': False })
+        self.assertEqual(client.batches, [['leftpad', 'react'], ['redux']])
+        self.assertEqual(oracle.stats()['requests'], 3)
+
+    def test_failed_reply(self):
+        client = FakeImpactClient(react = 10, lodash = None)
+        oracle = RelevanceOracle(client)
+        self.assertEqual(oracle.check(['react', 'lodash.map']), { 'react': True, 'lodash.map': False })
+        oracle.check(['react', 'lodash.map'])
+        # the failed package isn't cached
+        self.assertEqual(client.batches, [['lodash', 'react'], ['lodash']])
+        self.assertEqual(oracle.stats()['errors'], 2)
+
+    def test_ttl(self):
+        client = FakeImpactClient(react = 10)
+        oracle = RelevanceOracle(client, ttl = .01)
+        oracle.check(['react'])
+        time.sleep(.05)
+        oracle.check(['react'])
+        self.assertEqual(len(client.batches), 2)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'javascript.json')
+            oracle = RelevanceOracle(FakeImpactClient(react = 10))
+            oracle.check(['react', 'leftpad'])
+            oracle.save_snapshot(path)
+            client = FakeImpactClient()
+            self.assertEqual(RelevanceOracle(client, snapshot = path).check(['react.Component', 'leftpad']), { 'react.Component': True, 'leftpad': False })
+            self.assertEqual(client.batches, [])
+
+    def test_parser(self):
+        parser = JavascriptParser(callback = None)
+        parser.parsers = [ CountingParserClient() ]
+        parser._relevance_checker = FakeImpactClient()
+        parser.get_module_counts('rebase/foo', FakeCommit('1' * 40, **{ 'foo.js': FakeBlob('a' * 40, b'') }), 'foo.js')
+        self.assertTrue(parser.check_relevance('__stdlib__.path'))
+        self.assertEqual(parser._relevance_checker.batches, [])
+
+class FakeTreeItem(object):
+    def __init__(self, path):
+        self.path = path
+        self.type = 'blob'
+
+class FakeTree(object):
+    def __init__(self, hexsha, *paths):
+        self.hexsha = hexsha
+        self.paths = paths
+        self.traversals = 0
+
+    def traverse(self, predicate):
+        self.traversals += 1
+        return [ item for item in map(FakeTreeItem, self.paths) if predicate(item, 0) ]
+
+    def diff(self, other):
+        before, after = set(self.paths), set(other.paths)
+        return [ FakeDiff(path, None) for path in before - after ] + [ FakeDiff(None, path) for path in after - before ]
+
+class FakeDiff(object):
+    def __init__(self, a_path, b_path):
+        self.a_path, self.a_blob = a_path, a_path and FakeTreeItem(a_path)
+        self.b_path, self.b_blob = b_path, b_path and FakeTreeItem(b_path)
+
+class FakeTreeCommit(object):
+    def __init__(self, tree, *parents):
+        self.hexsha = tree.hexsha
+        self.tree = tree
+        self.parents = parents
+
+class TestPrivateModuleIndex(unittest.TestCase):
+    paths = (
+        'setup.py', 'README.md', 'src/foo/__init__.py', 'src/foo/bar/__init__.py', 'src/foo/bar/baz.py',
+        'src/foo/qux.py', 'tests/__init__.py', 'tests/foo/__init__.py', 'tests/test_foo.py', 'tools/script.py',
+    )
+
+    def setUp(self):
+        self.parser = PythonParser(callback = None)
+
+    def test_modules(self):
+        tree = FakeTree('1' * 40, *self.paths)
+        self.assertEqual(self.parser.get_private_modules(tree, 'src/foo/qux.py'), ['.', 'bar', 'foo', 'foo.bar', 'tests'])
+        self.assertEqual(self.parser.get_private_modules(tree, 'src/foo/bar/baz.py'), ['.', 'foo', 'foo.bar', 'tests'])
+        self.assertEqual(self.parser.get_private_modules(tree, 'tests/test_foo.py'), ['.', 'foo', 'foo.bar', 'tests'])
+        self.assertEqual(self.parser.get_private_modules(tree, 'setup.py'), ['foo', 'foo.bar', 'tests'])
+        self.assertEqual(self.parser.get_private_modules(FakeTree('2' * 40, 'setup.py'), 'setup.py'), [])
+        self.assertEqual(tree.traversals, 1)
+
+    def test_root_package(self):
+        tree = FakeTree('1' * 40, '__init__.py', 'foo/__init__.py', 'foo/bar.py')
+        self.assertEqual(self.parser.get_private_modules(tree, 'bar.py'), ['.', 'foo'])
+        self.assertEqual(self.parser.get_private_modules(tree, 'foo/bar.py'), ['.', 'foo'])
+
+    def test_incremental(self):
+        parent = FakeTreeCommit(FakeTree('1' * 40, *self.paths))
+        tree = FakeTree('2' * 40, 'src/foo/baz/__init__.py', *(path for path in self.paths if not path.startswith('tests/')))
+        commit = FakeTreeCommit(tree, parent)
+        self.parser.get_context('rebase/foo', parent, 'src/foo/qux.py')
+        self.assertEqual(self.parser.get_context('rebase/foo', commit, 'src/foo/qux.py')['private_modules'], ['.', 'bar', 'baz', 'foo', 'foo.bar', 'foo.baz'])
+        self.assertEqual(tree.traversals, 0)
+        self.assertEqual(self.parser.private_module_indexes.stats(), { 'size': 2, 'built': 1, 'updated': 1 })
+        self.assertEqual(self.parser.private_module_indexes.index(commit).packages, PrivateModuleIndex.from_tree(tree).packages)
+
+    def tearDown(self):
+        self.parser.close()
+
+class DialectParserClient(object):
+    def __init__(self, python2):
+        self.python2 = python2
+        self.requests = 0
+
+    def send(self, request):
+        self.requests += 1
+        code = base64.b64decode(json.loads(request)['code'])
+        if code.startswith(b'print ') != self.python2:
+            return { 'error': 'SyntaxError', 'message': 'invalid syntax' }
+        return { 'use_count': {} }
+
+    def close(self):
+        pass
+
+class TestDialectRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = PythonParser(callback = None)
+        self.parser.parsers = [ DialectParserClient(python2 = False), DialectParserClient(python2 = True) ]
+        self.parser.private_module_indexes.index = lambda commit: PrivateModuleIndex([])
+
+    def analyze(self, repo_name, path, code):
+        commit = FakeCommit(hashlib.sha1(code + path.encode('utf-8')).hexdigest(), **{ path: FakeBlob(hashlib.sha1(code).hexdigest(), code) })
+        self.parser.get_module_counts(repo_name, commit, path)
+
+    def test_routed_by_repository(self):
+        for index in range(10):
+            self.analyze('rebase/py2', 'foo{}.py'.format(index), b'print "hello %d"' % index)
+            self.analyze('rebase/py3', 'foo{}.py'.format(index), b'print("hello %d")' % index)
+        # only the first file of each repository was sent to the parser of the other dialect
+        self.assertEqual([ parser.requests for parser in self.parser.parsers ], [11, 11])
+        self.assertEqual(self.parser.dialect_stats(), {
+            'python3': { 'routed': 10, 'fallbacks': 1, 'fallback_rate': .1 },
+            'python2': { 'routed': 10, 'fallbacks': 1, 'fallback_rate': .1 },
+        })
+
+    def test_routed_by_directory(self):
+        for index in range(5):
+            self.analyze('rebase/foo', 'src/foo{}.py'.format(index), b'print("hello %d")' % index)
+        self.analyze('rebase/foo', 'vendor/six/six.py', b'print "six"')
+        self.assertEqual(self.parser.router.order('rebase/foo', 'vendor/six/moves.py'), ['python2', 'python3'])
+        self.assertEqual(self.parser.router.order('rebase/foo', 'vendor/other.py'), ['python2', 'python3'])
+        self.assertEqual(self.parser.router.order('rebase/foo', 'src/bar.py'), ['python3', 'python2'])
+        self.assertEqual(self.parser.router.order('rebase/foo', 'setup.py'), ['python3', 'python2'])
+        self.assertEqual(self.parser.router.order('rebase/bar', 'setup.py'), ['python3', 'python2'])
+
+    def test_failing_parser(self):
+        class FailingParserClient(object):
+            def send(self, request):
+                raise ConnectionError('Connection to python_parser:25252 closed')
+            def close(self):
+                pass
+        self.parser.parsers[0] = FailingParserClient()
+        self.analyze('rebase/foo', 'foo.py', b'print "hello"')
+        self.assertEqual(self.parser.parsers[1].requests, 1)
+        self.assertEqual(self.parser.dialect_stats()['python3']['fallbacks'], 1)
+        self.parser.parsers[1] = FailingParserClient()
+        with self.assertRaises(ConnectionError):
+            self.analyze('rebase/foo', 'bar.py', b'print "hello"')
+
+    def test_failed_handler(self):
+        class NoneParserClient(object):
+            def send(self, request):
+                return None
+            def close(self):
+                pass
+        self.parser.parsers = [ NoneParserClient(), NoneParserClient() ]
+        with self.assertRaises(exceptions.UnparsableCode):
+            self.analyze('rebase/foo', 'foo.py', b'print "hello"')
+        self.assertEqual(self.parser.dialect_stats()['python3'], { 'routed': 1, 'fallbacks': 1, 'fallback_rate': 1 })
+
+    def test_migration(self):
+        router = DialectRouter(['python3', 'python2'])
+        for _ in range(20):
+            router.record('rebase/foo', 'foo.py', 'python2', 'python2')
+        for _ in range(8):
+            router.record('rebase/foo', 'foo.py', 'python2', 'python3')
+        self.assertEqual(router.order('rebase/foo', 'foo.py'), ['python3', 'python2'])
+
+    def test_unparsable(self):
+        router = DialectRouter(['python3', 'python2'], max_entries = 2)
+        router.record('rebase/foo', 'src/foo.py', 'python3', None)
+        self.assertEqual(router.stats()['python3'], { 'routed': 1, 'fallbacks': 1, 'fallback_rate': 1 })
+        self.assertEqual(router.order('rebase/foo', 'src/foo.py'), ['python3', 'python2'])
+
+    def tearDown(self):
+        self.parser.close()
+
 if __name__ == '__main__':
     unittest.main()